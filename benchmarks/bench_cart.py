@@ -0,0 +1,974 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Offline benchmark of the cart endpoints.
+
+Galatea, Tryton and the sale.cart, product.product, carrier and sale.shop
+models are replaced by in-memory fakes. Every ORM call (search, browse,
+read, create, write, delete) waits --latency seconds and every carrier
+formula --carrier-latency seconds, so the numbers follow the number of
+database round-trips of each endpoint. As in Tryton, the first field access
+of a record reads all the records of its group (the records of a search,
+a browse or a relation of a group).
+
+Usage:
+
+    python benchmarks/bench_cart.py
+    python benchmarks/bench_cart.py --sizes 1,10 --iterations 5
+    python benchmarks/bench_cart.py --save-baseline
+    python benchmarks/bench_cart.py --read-database replica
+
+With --read-database GET endpoints run on a second fake database whose
+pool is only available once initialized, as the Tryton pool of each
+database; relations resolve Pool() from the transaction database.
+
+Without --save-baseline results are compared with the baseline file; the
+run fails when an endpoint does more ORM calls or its p50 latency is over
+the baseline plus --tolerance. Latencies depend on the machine, so the
+committed baseline only has ORM calls and p50 is compared once a baseline
+of the machine is saved (--save-baseline, --baseline for another file).
+'''
+import os
+import sys
+import time
+import types
+import argparse
+import logging
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime
+from decimal import Decimal
+
+from flask import Flask, g, json, request
+from flask.sessions import SessionInterface, SessionMixin
+from jinja2 import DictLoader
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+DATABASE = 'bench'
+SHOP = 1
+WEBSITE = 1
+LANG = 'en'
+ENDPOINTS = ['add', 'my_cart', 'carriers', 'cart_list', 'checkout', 'confirm']
+
+
+class Settings(object):
+    latency = 0.0005
+    carrier_latency = 0.001
+
+STATS = Counter()
+STARTUP = OrderedDict()
+CSRF_EXEMPT = set()
+BUDGET_WARNINGS = [] # query budgets logged (not raised) by writing requests
+# JSON views posted without a CSRF token
+CSRF_EXEMPT_ENDPOINTS = ['cart.add', 'cart.add-bulk']
+
+
+def orm(name):
+    STATS[name] += 1
+    if Settings.latency:
+        time.sleep(Settings.latency)
+
+
+# Tryton fakes
+
+class FakeTransaction(object):
+    _local = threading.local()
+
+    def __new__(cls):
+        transaction = getattr(cls._local, 'transaction', None)
+        if transaction is None:
+            transaction = object.__new__(cls)
+            transaction.database = DATABASE
+            transaction.user = 1
+            transaction.language = LANG
+            transaction.context = {}
+            cls._local.transaction = transaction
+        return transaction
+
+    @contextmanager
+    def set_context(self, context=None, **kwargs):
+        old = self.context
+        self.context = dict(old)
+        self.context.update(context or {})
+        self.context.update(kwargs)
+        try:
+            yield self
+        finally:
+            self.context = old
+
+    @contextmanager
+    def start(self, database, user, readonly=False, context=None):
+        old = self.database
+        self.database = database
+        try:
+            with self.set_context(context):
+                yield self
+        finally:
+            self.database = old
+
+    def commit(self):
+        pass
+
+
+class FakePool(object):
+    "Pool of a database (of the transaction by default); get() fails until " \
+        "init() like the Tryton pool of a database not loaded"
+    models = {}
+    databases = set()
+
+    def __init__(self, database_name=None):
+        if database_name is None:
+            database_name = FakeTransaction().database
+        self.database_name = database_name
+
+    @classmethod
+    def database_list(cls):
+        return list(cls.databases)
+
+    def init(self):
+        self.databases.add(self.database_name)
+
+    def get(self, name):
+        if self.database_name not in self.databases:
+            raise KeyError('Pool of database %s is not initialized: %s' % (
+                    self.database_name, name))
+        return self.models[name]
+
+
+class FakeTryton(object):
+    pool = FakePool(DATABASE)
+
+    def transaction(self, readonly=None, user=None, context=None):
+        def decorator(func):
+            def wrapper(*args, **kwargs):
+                return func(*args, **kwargs)
+            wrapper.__name__ = func.__name__
+            wrapper.__doc__ = func.__doc__
+            return wrapper
+        return decorator
+
+
+def register(name):
+    def decorator(cls):
+        cls._name = name
+        cls.__name__ = name # Tryton classes are named by the model
+        cls._records = {}
+        FakePool.models[name] = cls
+        return cls
+    return decorator
+
+
+def resolve(record, path):
+    '''Return the value of a dotted path without loading records'''
+    value = record
+    for name in path.split('.'):
+        if value is None:
+            return None
+        if isinstance(value, FakeModel):
+            value = value._get(name)
+        else:
+            value = getattr(value, name)
+    if isinstance(value, FakeModel):
+        return value.id
+    if isinstance(value, list):
+        return [v.id if isinstance(v, FakeModel) else v for v in value]
+    return value
+
+
+def match(record, domain):
+    if not domain:
+        return True
+    if isinstance(domain, tuple):
+        field, operator, operand = domain
+        value = resolve(record, field)
+        if isinstance(value, list):
+            if operator == 'in':
+                return bool(set(value) & set(operand))
+            return False
+        if isinstance(operand, FakeModel):
+            operand = operand.id
+        if field == 'id' and isinstance(operand, basestring):
+            operand = int(operand) # Tryton converts domain values
+        if operator == '=':
+            return value == operand
+        if operator == '!=':
+            return value != operand
+        if operator == 'in':
+            return value in operand
+        if operator == 'not in':
+            return value not in operand
+        if operator == '<':
+            return value is not None and value < operand
+        if operator == '<=':
+            return value is not None and value <= operand
+        if operator == '>':
+            return value is not None and value > operand
+        if operator == '>=':
+            return value is not None and value >= operand
+        raise ValueError(operator)
+    if domain[0] == 'OR':
+        return any(match(record, d) for d in domain[1:])
+    if domain[0] == 'AND':
+        domain = domain[1:]
+    return all(match(record, d) for d in domain)
+
+
+def new_group(ids):
+    return {'ids': list(ids), 'loaded': False, 'relations': {}}
+
+
+class FakeModel(object):
+    "Record of a fake model. As Tryton records, the first field access " \
+        "reads all the records of its group (search, browse or relation)"
+    _name = None
+    _records = None
+    _relations = {}
+    _defaults = {}
+    _fields = {}
+
+    def __init__(self, id=None, _group=None, **values):
+        self.__dict__['id'] = int(id) if id is not None else None
+        self.__dict__['_values'] = dict(values)
+        self.__dict__['_group'] = _group or new_group([self.id])
+
+    @classmethod
+    def _instances(cls, ids):
+        group = new_group(ids)
+        return [cls(i, _group=group) for i in ids]
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if (name not in self._values and self.id is not None
+                and not self._group['loaded']):
+            self._group['loaded'] = True
+            type(self).read([i for i in self._group['ids']
+                    if i in self._records], [])
+        return self._get(name, True)
+
+    def _get(self, name, grouped=False):
+        if name in self._values:
+            value = self._values[name]
+        elif self.id in self._records:
+            value = self._records[self.id].get(name)
+        else:
+            value = None
+        relation = self._relations.get(name)
+        if relation and value is not None:
+            Model = FakePool().get(relation)
+            group = None
+            if grouped:
+                group = self._group['relations'].get(name)
+                if group is None:
+                    group = self._group['relations'][name] = new_group(
+                        self._related_ids(name))
+            if isinstance(value, (list, tuple)):
+                return [v if isinstance(v, FakeModel) else Model(v, group)
+                    for v in value]
+            if not isinstance(value, FakeModel):
+                return Model(value, group)
+        return value
+
+    def _related_ids(self, name):
+        ids = []
+        for record_id in self._group['ids']:
+            value = self._records.get(record_id, {}).get(name)
+            if not isinstance(value, (list, tuple)):
+                value = [value]
+            for v in value:
+                if isinstance(v, FakeModel):
+                    v = v.id
+                if v is not None and v not in ids:
+                    ids.append(v)
+        return ids
+
+    def __setattr__(self, name, value):
+        self._values[name] = value
+
+    def __eq__(self, other):
+        return (isinstance(other, FakeModel) and self._name == other._name
+            and self.id == other.id)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self._name, self.id))
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    @property
+    def _save_values(self):
+        values = {}
+        for key, value in self._values.iteritems():
+            if isinstance(value, FakeModel):
+                value = value.id
+            values[key] = value
+        return values
+
+    def save(self):
+        orm('create')
+        self.__dict__['id'] = self._store(self._save_values)
+
+    @classmethod
+    def _store(cls, values):
+        record_id = max(cls._records.keys() or [0]) + 1
+        values = dict(values)
+        values['id'] = record_id
+        values.setdefault('create_date', datetime.now())
+        cls._records[record_id] = values
+        return record_id
+
+    @classmethod
+    def search(cls, domain, offset=0, limit=None, order=None):
+        orm('search')
+        records = [cls(i) for i in sorted(cls._records)
+            if match(cls(i), domain)]
+        for field, direction in reversed(order or []):
+            records.sort(key=lambda r: resolve(r, field),
+                reverse=direction == 'DESC')
+        records = records[offset:]
+        if limit:
+            records = records[:limit]
+        return cls._instances([r.id for r in records])
+
+    @classmethod
+    def browse(cls, ids):
+        orm('browse')
+        return cls._instances(ids)
+
+    @classmethod
+    def read(cls, ids, fields_names):
+        orm('read')
+        result = []
+        for record_id in ids:
+            record = cls(record_id)
+            values = {'id': record_id}
+            for name in fields_names:
+                values[name] = resolve(record, name)
+            result.append(values)
+        return result
+
+    @classmethod
+    def create(cls, vlist):
+        orm('create')
+        return cls._instances([cls._store(v) for v in vlist])
+
+    @classmethod
+    def write(cls, *args):
+        orm('write')
+        for records, values in zip(args[::2], args[1::2]):
+            for record in records:
+                for key, value in values.iteritems():
+                    if isinstance(value, FakeModel):
+                        value = value.id
+                    cls._records[record.id][key] = value
+                cls._records[record.id]['write_date'] = datetime.now()
+
+    @classmethod
+    def delete(cls, records):
+        orm('delete')
+        for record in records:
+            cls._records.pop(record.id, None)
+
+    @classmethod
+    def default_get(cls, fields_names, with_rec_name=True):
+        orm('default_get')
+        return dict(cls._defaults)
+
+
+@register('galatea.website')
+class Website(FakeModel):
+    pass
+
+
+@register('galatea.user')
+class GalateaUser(FakeModel):
+    _relations = {
+        'invoice_address': 'party.address',
+        'shipment_address': 'party.address',
+        }
+
+
+@register('sale.shop')
+class Shop(FakeModel):
+    _relations = {
+        'esale_currency': 'currency.currency',
+        'esale_country': 'country.country',
+        'esale_countrys': 'country.country',
+        'esale_payments': 'sale.shop-esale.payment',
+        'esale_carriers': 'sale.shop-carrier',
+        'esale_delivery_product': 'product.product',
+        }
+
+
+@register('currency.currency')
+class Currency(FakeModel):
+    pass
+
+
+@register('sale.shop-esale.payment')
+class ShopPayment(FakeModel):
+    _relations = {'payment_type': 'account.payment.type'}
+
+
+@register('sale.shop-carrier')
+class ShopCarrier(FakeModel):
+    _relations = {'carrier': 'carrier'}
+
+
+@register('account.payment.type')
+class PaymentType(FakeModel):
+    pass
+
+
+@register('country.country')
+class Country(FakeModel):
+    pass
+
+
+@register('country.subdivision')
+class Subdivision(FakeModel):
+    pass
+
+
+@register('product.template')
+class Template(FakeModel):
+    _relations = {'esale_crosssells_by_shop': 'product.template'}
+
+
+@register('product.product')
+class Product(FakeModel):
+    _relations = {'template': 'product.template'}
+
+
+@register('carrier')
+class Carrier(FakeModel):
+
+    def get_sale_price(self):
+        if Settings.carrier_latency:
+            time.sleep(Settings.carrier_latency)
+        sale = FakeTransaction().context['record']
+        return (Decimal('4.95') + Decimal(self.id)
+            + Decimal(sale.total_amount or 0) / 100, None)
+
+    def get_sale_price_w_tax(self, price, party=None):
+        return price * Decimal('1.21')
+
+    @classmethod
+    def get_carriers_from_zip(cls, zip):
+        orm('search')
+        return [cls(i) for i, v in cls._records.iteritems()
+            if any(zip.startswith(z) for z in v['zips'])]
+
+    @classmethod
+    def get_products_stockable(cls, product_ids):
+        orm('read')
+        return any(Product._records[i]['type'] == 'goods'
+            for i in product_ids)
+
+
+@register('party.party')
+class Party(FakeModel):
+    _relations = {
+        'carrier': 'carrier',
+        'customer_payment_type': 'account.payment.type',
+        'addresses': 'party.address',
+        }
+
+    @classmethod
+    def esale_create_party(cls, shop, values):
+        return cls.create([values])[0]
+
+
+@register('party.address')
+class Address(FakeModel):
+
+    @classmethod
+    def esale_create_address(cls, shop, party, values, type=None):
+        values = dict(values, party=party.id)
+        return cls.create([values])[0]
+
+
+@register('sale.sale')
+class Sale(FakeModel):
+    _relations = {
+        'party': 'party.party',
+        'lines': 'sale.line',
+        }
+
+    @classmethod
+    def quote(cls, sales):
+        cls.write(sales, {'state': 'quotation'})
+
+
+@register('sale.line')
+class SaleLine(FakeModel):
+    _relations = {'product': 'product.product'}
+
+    @classmethod
+    def get_shipment_line(cls, product, price, sale, party):
+        return cls(product=product.id, unit_price=price, sale=sale.id,
+            quantity=1)
+
+
+@register('sale.cart')
+class Cart(FakeModel):
+    _relations = {
+        'product': 'product.product',
+        'galatea_user': 'galatea.user',
+        'party': 'party.party',
+        }
+    _fields = dict.fromkeys(['state', 'shop', 'cart_date', 'quantity',
+        'product', 'party', 'sid', 'galatea_user', 'unit_price',
+        'unit_price_w_tax', 'untaxed_amount', 'amount_w_tax'])
+
+    def on_change_quantity(self):
+        unit_price = self.unit_price or Decimal(0)
+        quantity = Decimal(str(self.quantity or 0))
+        self.untaxed_amount = unit_price * quantity
+        self.amount_w_tax = self.unit_price_w_tax * quantity
+
+    def on_change_product(self):
+        self.unit_price = self.product.list_price
+        self.unit_price_w_tax = self.product.list_price * Decimal('1.21')
+        self.on_change_quantity()
+
+    @classmethod
+    def create(cls, vlist):
+        # prices with tax and amounts are function fields in Tryton
+        vlist = [dict(v) for v in vlist]
+        for values in vlist:
+            price = values.get('unit_price') or Decimal(0)
+            quantity = Decimal(str(values.get('quantity') or 0))
+            if values.get('unit_price_w_tax') is None:
+                values['unit_price_w_tax'] = price * Decimal('1.21')
+            if values.get('untaxed_amount') is None:
+                values['untaxed_amount'] = price * quantity
+            if values.get('amount_w_tax') is None:
+                values['amount_w_tax'] = (values['unit_price_w_tax']
+                    * quantity)
+        return super(Cart, cls).create(vlist)
+
+    @classmethod
+    def create_sale(cls, carts, values):
+        party = carts[0].party
+        sale, = Sale.create([dict(values, party=party.id if party else None,
+            state='draft', shop=SHOP)])
+        lines = SaleLine.create([{
+                    'product': c.product.id,
+                    'quantity': c.quantity,
+                    'unit_price': c.unit_price,
+                    'sale': sale.id,
+                    } for c in carts])
+        Sale.write([sale], {'lines': [l.id for l in lines]})
+        cls.write(carts, {'state': 'done'})
+        return [sale], None
+
+
+def install_stubs():
+    '''Register fake galatea and trytond modules (and the optional
+    dependencies that are not installed)'''
+    def module(name, **attrs):
+        mod = types.ModuleType(name)
+        mod.__dict__.update(attrs)
+        sys.modules[name] = mod
+        return mod
+
+    identity = lambda func: func
+    module('galatea')
+    module('galatea.tryton', tryton=FakeTryton())
+    def exempt(view):
+        CSRF_EXEMPT.add(view)
+        return view
+    module('galatea.csrf', csrf=type('CSRF', (object,),
+            {'exempt': staticmethod(exempt)})())
+    module('galatea.utils', thumbnail=lambda filename, name, size:
+        '/thumbnails/%s/%s-%s' % (size, filename, name))
+    module('galatea.helpers', login_required=identity,
+        customer_required=identity)
+    module('trytond')
+    module('trytond.transaction', Transaction=FakeTransaction)
+    module('trytond.pool', Pool=FakePool)
+    module('trytond.model', ModelStorage=FakeModel)
+    FakeTryton.pool.init()
+
+    try:
+        import flask_babel
+    except ImportError:
+        module('flask_babel', gettext=lambda s, **kw: s % kw if kw else s,
+            lazy_gettext=lambda s, **kw: s, get_locale=lambda: None,
+            ngettext=lambda s, p, n, **kw: (s if n == 1 else p) % dict(
+                kw, num=n))
+    try:
+        import flask_wtf, wtforms
+    except ImportError:
+        class Field(object):
+            def __init__(self, *args, **kwargs):
+                self.choices = []
+
+        class Form(object):
+            def __init__(self, *args, **kwargs):
+                for name in dir(type(self)):
+                    if isinstance(getattr(type(self), name), Field):
+                        setattr(self, name, Field())
+
+            def validate(self):
+                return True
+
+        module('flask_wtf', Form=Form)
+        module('wtforms', TextField=Field, SelectField=Field,
+            IntegerField=Field, validators=types.ModuleType('validators'))
+        for name in ('Required', 'Email'):
+            setattr(sys.modules['wtforms'].validators, name,
+                lambda *args, **kwargs: None)
+    try:
+        import emailvalid
+    except ImportError:
+        module('emailvalid', check_email=lambda email: bool(email)
+            and '@' in email)
+    try:
+        import babel.numbers
+    except ImportError:
+        def parse_decimal(string, locale=None):
+            try:
+                return Decimal(string.replace('.', '').replace(',', '.'))
+            except ArithmeticError:
+                raise ValueError(string)
+        module('babel')
+        module('babel.numbers', parse_decimal=parse_decimal)
+    try:
+        import sql
+    except ImportError:
+        module('sql', Table=lambda name: None)
+    try:
+        import vatnumber
+    except ImportError:
+        module('vatnumber', countries=lambda: ['ES', 'FR'],
+            check_vat=lambda vat: True)
+
+
+class MemorySession(dict, SessionMixin):
+
+    def __init__(self, sid, values=None):
+        dict.__init__(self, values or {})
+        self.sid = sid
+        self.modified = False
+
+
+class MemorySessionInterface(SessionInterface):
+    sessions = {}
+    last_sid = None
+
+    def open_session(self, app, request):
+        sid = request.cookies.get('sid')
+        if not sid or sid not in self.sessions:
+            sid = os.urandom(8).encode('hex')
+        return MemorySession(sid, self.sessions.get(sid))
+
+    def save_session(self, app, session, response):
+        self.sessions[session.sid] = dict(session)
+        MemorySessionInterface.last_sid = session.sid
+        response.set_cookie('sid', session.sid)
+
+
+TEMPLATES = {
+    'cart.html': '{% for c in carts %}{{ c.product.rec_name }} '
+        '{{ c.quantity }}{% endfor %}{{ prices.total_amount }}'
+        '{% for c in carriers %}{{ c.name }}{% endfor %}'
+        '{% for c in crossells %}{{ c.rec_name }}{% endfor %}',
+    'checkout.html': '{% for c in carts %}{{ c.product.rec_name }}'
+        '{% endfor %}{{ prices.total_amount }}{{ values.carrier_cost }}',
+    'cart-pending.html': '{% for c in carts %}{{ c.id }}{% endfor %}',
+    }
+
+
+class BudgetHandler(logging.Handler):
+    "Collect the query budgets logged by the cart"
+
+    def emit(self, record):
+        message = record.getMessage()
+        if ' ORM calls in ' in message:
+            BUDGET_WARNINGS.append(message)
+
+
+def create_app(read_database=None):
+    install_stubs()
+    app = Flask('bench_cart')
+    app.config.update({
+        'SECRET_KEY': 'bench',
+        'TRYTON_DATABASE': DATABASE,
+        'TRYTON_GALATEA_SITE': WEBSITE,
+        'TRYTON_SALE_SHOP': SHOP,
+        'TRYTON_SALE_SHOPS': [SHOP],
+        'BASE_IMAGE': '/static/images/base.png',
+        'TRYTON_CART_QUERY_BUDGET': 'raise',
+        'TRYTON_CART_READ_DATABASE': read_database,
+        })
+    app.session_interface = MemorySessionInterface()
+    app.logger.addHandler(BudgetHandler())
+    app.jinja_loader = DictLoader(TEMPLATES)
+
+    @app.before_request
+    def set_language():
+        g.language = (request.view_args or {}).get('lang', LANG)
+
+    @app.route('/<lang>/catalog/<slug>', endpoint='catalog.product_' + LANG)
+    def product(lang, slug):
+        return slug
+
+    @app.route('/<lang>/sale/<int:id>', endpoint='sale.sale')
+    def sale(lang, id):
+        return str(id)
+
+    with app.app_context():
+        sys.path.insert(0, ROOT)
+        start = time.time()
+        import cart as cart_module
+        STARTUP['import'] = time.time() - start
+    start = time.time()
+    cart_module.init_app(app)
+    STARTUP['init_app'] = time.time() - start
+    app.register_blueprint(cart_module.cart, url_prefix='/<lang>/cart')
+    for endpoint in CSRF_EXEMPT_ENDPOINTS:
+        if app.view_functions[endpoint] not in CSRF_EXEMPT:
+            raise RuntimeError('%s is not CSRF exempt' % endpoint)
+    return app, cart_module
+
+
+def seed(products=600, carriers=8, crosssells=4):
+    '''Fill the fake database'''
+    for Model in FakePool.models.values():
+        Model._records.clear()
+    Currency._store({'digits': 2, 'symbol': u'€'})
+    Country._store({'name': 'Spain', 'code': 'ES'})
+    Subdivision._store({'name': 'Barcelona'})
+    PaymentType._store({'name': 'Card', 'rec_name': 'Card'})
+    ShopPayment._store({'payment_type': 1})
+    for i in range(1, carriers + 1):
+        Carrier._store({'rec_name': 'Carrier %s' % i,
+            'zips': ['0'] if i % 2 else ['08', '17'],
+            'write_date': datetime(2026, 1, 1)})
+        ShopCarrier._store({'carrier': i})
+    for i in range(1, products + 1):
+        Template._store({
+            'rec_name': 'Product %s' % i,
+            'esale_slug': 'product-%s' % i,
+            'esale_available': True,
+            'esale_active': True,
+            'shops': [SHOP],
+            'esale_default_images': {'small': {
+                'name': 'product-%s.jpg' % i, 'digest': 'd%s' % i}},
+            'esale_crosssells_by_shop': [(i + j) % products + 1
+                for j in range(crosssells)],
+            })
+        Product._store({
+            'code': 'P%04d' % i,
+            'rec_name': 'Product %s' % i,
+            'template': i,
+            'type': 'goods',
+            'add_cart': True,
+            'list_price': Decimal('10.00') + i,
+            'esale_quantity': 1000.0,
+            'esale_forecast_quantity': 1000.0,
+            })
+    Shop._store({
+        'esale_currency': 1,
+        'esale_country': 1,
+        'esale_countrys': [1],
+        'esale_payments': [1],
+        'esale_carriers': range(1, carriers + 1),
+        'esale_delivery_product': products,
+        'write_date': datetime(2026, 1, 1),
+        })
+    Website._store({'esale_stock': True, 'esale_stock_qty': 'quantity'})
+    Cart._defaults = {
+        'state': 'draft',
+        'shop': SHOP,
+        'cart_date': date.today(),
+        }
+
+
+def fill_cart(sid, size):
+    '''Replace the carts of a session with size lines (not measured)'''
+    for cart_id in [i for i, v in Cart._records.iteritems()
+            if v.get('sid') == sid]:
+        del Cart._records[cart_id]
+    for product_id in range(1, size + 1):
+        product = Product(product_id)
+        price = product.list_price
+        Cart._store({
+            'state': 'draft',
+            'shop': SHOP,
+            'cart_date': date.today(),
+            'sid': sid,
+            'galatea_user': None,
+            'party': None,
+            'product': product_id,
+            'quantity': 1.0,
+            'unit_price': price,
+            'unit_price_w_tax': price * Decimal('1.21'),
+            'untaxed_amount': price,
+            'amount_w_tax': price * Decimal('1.21'),
+            })
+
+
+def clear_caches(cart_module):
+    for name in dir(cart_module):
+        value = getattr(cart_module, name)
+        if isinstance(value, cart_module.LRUCache):
+            value.clear()
+
+
+CHECKOUT_FORM = {
+    'shipment_address': 'new-address',
+    'shipment_name': 'Bench',
+    'shipment_street': 'Street 1',
+    'shipment_zip': '08001',
+    'shipment_city': 'Barcelona',
+    'shipment_email': 'bench@example.com',
+    'shipment_country': '1',
+    'payment': '1',
+    'payment_type': '1',
+    'carrier': '1',
+    }
+
+
+def request_for(client, endpoint, size):
+    prefix = '/%s/cart' % LANG
+    if endpoint == 'add':
+        lines = [{'name': 'product-%s' % i, 'value': 1}
+            for i in range(1, size + 1)]
+        return client.post(prefix + '/add/', data=json.dumps(lines),
+            content_type='application/json')
+    if endpoint == 'my_cart':
+        return client.get(prefix + '/json/my-cart')
+    if endpoint == 'carriers':
+        return client.get(prefix + '/carriers?zip=08001&payment=1')
+    if endpoint == 'cart_list':
+        return client.get(prefix + '/')
+    if endpoint == 'checkout':
+        return client.post(prefix + '/checkout/', data=CHECKOUT_FORM)
+    if endpoint == 'confirm':
+        return client.post(prefix + '/confirm/', data=CHECKOUT_FORM)
+    raise ValueError(endpoint)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+def run(app, cart_module, sizes, iterations, warm=False):
+    results = OrderedDict()
+    for endpoint in ENDPOINTS:
+        for size in sizes:
+            client = app.test_client()
+            request_for(client, 'my_cart', 0) # open the session
+            sid = MemorySessionInterface.last_sid
+            times = []
+            calls = Counter()
+            requests_calls = []
+            for i in range(iterations):
+                fill_cart(sid, 0 if endpoint == 'add' else size)
+                if not warm:
+                    clear_caches(cart_module)
+                STATS.clear()
+                start = time.time()
+                response = request_for(client, endpoint, size)
+                times.append(time.time() - start)
+                if response.status_code >= 400:
+                    raise RuntimeError('%s (%s lines): HTTP %s\n%s' % (
+                        endpoint, size, response.status_code,
+                        response.data[:2000]))
+                if BUDGET_WARNINGS:
+                    raise RuntimeError('%s (%s lines): %s' % (endpoint,
+                            size, BUDGET_WARNINGS.pop()))
+                calls.update(STATS)
+                requests_calls.append(sum(v for k, v in STATS.iteritems()
+                        if k != 'default_get'))
+            total = sum(times)
+            results['%s:%s' % (endpoint, size)] = {
+                'endpoint': endpoint,
+                'lines': size,
+                'throughput': iterations / total if total else 0,
+                'p50': percentile(times, 50),
+                'p99': percentile(times, 99),
+                'orm_calls': percentile(requests_calls, 50),
+                'orm': dict((k, v / float(iterations))
+                    for k, v in calls.iteritems()),
+                }
+    return results
+
+
+def report(results):
+    print('%-10s %6s %10s %10s %10s %10s' % ('endpoint', 'lines', 'req/s',
+            'p50 ms', 'p99 ms', 'ORM calls'))
+    for result in results.itervalues():
+        print('%-10s %6s %10.1f %10.2f %10.2f %10.1f' % (result['endpoint'],
+                result['lines'], result['throughput'], result['p50'] * 1000,
+                result['p99'] * 1000, result['orm_calls']))
+
+
+def compare(results, baseline, tolerance):
+    failures = []
+    for key, result in results.iteritems():
+        base = baseline.get(key)
+        if not base:
+            continue
+        if result['orm_calls'] > base['orm_calls']:
+            failures.append('%s: %s ORM calls (baseline %s)' % (key,
+                    result['orm_calls'], base['orm_calls']))
+        if 'p50' in base and result['p50'] > base['p50'] * (1 + tolerance):
+            failures.append('%s: p50 %.2fms (baseline %.2fms)' % (key,
+                    result['p50'] * 1000, base['p50'] * 1000))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Cart endpoints benchmark')
+    parser.add_argument('--sizes', default='1,10,100,500')
+    parser.add_argument('--iterations', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=Settings.latency,
+        help='seconds by ORM call')
+    parser.add_argument('--carrier-latency', type=float,
+        default=Settings.carrier_latency,
+        help='seconds by carrier formula')
+    parser.add_argument('--warm', action='store_true',
+        help='keep the cart caches between requests')
+    parser.add_argument('--read-database',
+        help='route GET endpoints to a read replica database')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+        help='p50 latency allowed over the baseline (0.5 = 50%%)')
+    args = parser.parse_args(argv)
+
+    Settings.latency = args.latency
+    Settings.carrier_latency = args.carrier_latency
+    app, cart_module = create_app(args.read_database)
+    seed(products=max(600, max(int(s) for s in args.sizes.split(',')) + 1))
+    results = run(app, cart_module, [int(s) for s in args.sizes.split(',')],
+        args.iterations, args.warm)
+    print('Startup: %s' % ', '.join('%s %.2f ms' % (k, v * 1000)
+            for k, v in STARTUP.iteritems()))
+    report(results)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Baseline saved in %s' % args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as f:
+        failures = compare(results, json.load(f), args.tolerance)
+    for failure in failures:
+        print('REGRESSION %s' % failure)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,41 +1,361 @@
-from flask import Blueprint, render_template, current_app, abort, g, url_for, \
-    flash, redirect, session, request, jsonify
+from flask import Blueprint, current_app, abort, g, url_for, \
+    flash, redirect, session, request, jsonify, json, make_response, \
+    after_this_request, has_app_context
+from flask import render_template as flask_render_template
 from galatea.tryton import tryton
 from galatea.csrf import csrf
 from galatea.utils import thumbnail
 from galatea.helpers import login_required, customer_required
-from flask.ext.babel import gettext as _, lazy_gettext, ngettext
+from flask.ext.babel import gettext as _, lazy_gettext, ngettext, get_locale
+from babel.numbers import parse_decimal
 from flask.ext.wtf import Form
 from wtforms import TextField, SelectField, IntegerField, validators
+from trytond.model import ModelStorage
+from trytond.pool import Pool
 from trytond.transaction import Transaction
+from sql import Table
+from itsdangerous import URLSafeSerializer, BadSignature
 from decimal import Decimal
+from datetime import date, datetime, timedelta
 from emailvalid import check_email
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from bisect import bisect_right
+from array import array
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+import Queue
+import csv
+import hashlib
+import heapq
+import os
+import socket
+import threading
+import time
 import vatnumber
 
 cart = Blueprint('cart', __name__, template_folder='templates')
 
+# ORM calls counted by ModelProxy; reads (lazy loads of record fields
+# included) are counted in ModelStorage.read (count_record_reads)
+ORM_METHODS = ('search', 'browse', 'create', 'write', 'delete')
+# ORM calls allowed by endpoint: (calls, calls by cart line).
+# Tryton reads the records of a group (search, browse or relation) in
+# chunks, so each model read by line costs about a read by 100 lines; a read
+# by line (N+1) goes over the budget
+QUERY_BUDGETS = {
+    'cart.add': (10, 0.03),
+    'cart.add-bulk': (10, 0.03),
+    'cart.my-cart': (14, 0.03),
+    'cart.carriers': (18, 0.03),
+    'cart.crossells': (8, 0.02),
+    'cart.cart': (26, 0.04),
+    'cart.checkout': (26, 0.04),
+    'cart.confirm': (26, 0.05),
+    'cart.clone': (14, 0.03),
+    'cart.cart-pending': (6, 0.03),
+    }
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class ModelProxy(object):
+    "Tryton model resolved from the pool of the transaction database on " \
+        "first use. Counts ORM calls"
+    proxies = []
+
+    def __init__(self, model_name):
+        self._model_name = model_name
+        self._models = {} # database: model
+        ModelProxy.proxies.append(self)
+
+    def resolve(self):
+        database = transaction_database()
+        model = self._models.get(database)
+        if model is None:
+            pool = tryton.pool if database == DATABASE else Pool(database)
+            model = self._models[database] = pool.get(self._model_name)
+        return model
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self.resolve(), name)
+        if name in ORM_METHODS:
+            def counted(*args, **kwargs):
+                count_metric('orm_' + name)
+                return attr(*args, **kwargs)
+            return counted
+        return attr
+
+
+class CartMetrics(object):
+    "Latency histograms and counters by endpoint (Prometheus text format)"
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latency = {} # endpoint: [bucket counts, sum, count]
+        self._counters = {} # (endpoint, name): value
+
+    def observe(self, endpoint, seconds, stats):
+        with self._lock:
+            latency = self._latency.setdefault(endpoint,
+                [[0] * len(self.buckets), 0.0, 0])
+            for i, bucket in enumerate(self.buckets):
+                if seconds <= bucket:
+                    latency[0][i] += 1
+            latency[1] += seconds
+            latency[2] += 1
+            for name, value in stats.iteritems():
+                key = (endpoint, name)
+                self._counters[key] = self._counters.get(key, 0) + value
+
+    def prometheus(self):
+        '''Return metrics in Prometheus text format'''
+        lines = []
+        with self._lock:
+            lines.append('# TYPE galatea_cart_request_seconds histogram')
+            for endpoint, (counts, total, count) in \
+                    sorted(self._latency.iteritems()):
+                for bucket, value in zip(self.buckets, counts):
+                    lines.append('galatea_cart_request_seconds_bucket'
+                        '{endpoint="%s",le="%s"} %s' % (endpoint, bucket, value))
+                lines.append('galatea_cart_request_seconds_bucket'
+                    '{endpoint="%s",le="+Inf"} %s' % (endpoint, count))
+                lines.append('galatea_cart_request_seconds_sum'
+                    '{endpoint="%s"} %s' % (endpoint, total))
+                lines.append('galatea_cart_request_seconds_count'
+                    '{endpoint="%s"} %s' % (endpoint, count))
+            counters = sorted(self._counters.iteritems())
+        lines.append('# TYPE galatea_cart_orm_calls_total counter')
+        for (endpoint, name), value in counters:
+            if name.startswith('orm_'):
+                lines.append('galatea_cart_orm_calls_total'
+                    '{endpoint="%s",method="%s"} %s' % (
+                        endpoint, name[4:], value))
+        for name, metric in (
+                ('carrier_evaluations',
+                    'galatea_cart_carrier_evaluations_total'),
+                ('render_seconds', 'galatea_cart_render_seconds_total')):
+            lines.append('# TYPE %s counter' % metric)
+            for (endpoint, counter), value in counters:
+                if counter == name:
+                    lines.append('%s{endpoint="%s"} %s' % (
+                        metric, endpoint, value))
+        for name, value in sorted(QUOTE_QUEUE.metrics().iteritems()):
+            lines.append('# TYPE galatea_cart_quote_queue_%s gauge' % name)
+            lines.append('galatea_cart_quote_queue_%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+CART_METRICS = CartMetrics()
+
+def count_metric(name, value=1):
+    '''Add value to a counter of the current request'''
+    if not has_app_context():
+        return
+    stats = getattr(g, 'cart_stats', None)
+    if stats is not None:
+        stats[name] = stats.get(name, 0) + value
+
+def count_record_reads():
+    '''Count the reads of the cart models as orm_read.
+    Record field access (cart.product.template) reads the record group on
+    first use without calling the model, so reads are counted in
+    ModelStorage.read. Reads of other models and reads in uncounted_reads
+    blocks (Tryton methods as create_sale or quote) are not counted.
+    Installed once by process by init_app or the first request, only when
+    query budgets or metrics are enabled'''
+    if not (QUERY_BUDGET_MODE or CART_METRICS_ENABLED or CART_METRICS_LOG):
+        return
+    if getattr(ModelStorage.read, 'cart_counted', False):
+        return
+    read = ModelStorage.read.__func__
+    models = frozenset(p._model_name for p in ModelProxy.proxies)
+
+    def counted_read(cls, *args, **kwargs):
+        if cls.__name__ in models and has_app_context() \
+                and not getattr(g, 'cart_uncounted', 0):
+            count_metric('orm_read')
+        return read(cls, *args, **kwargs)
+    counted_read.cart_counted = True
+    ModelStorage.read = classmethod(counted_read)
+
+@contextmanager
+def uncounted_reads():
+    '''Do not count the record reads of the block (Tryton methods called by
+    the cart) in the ORM calls of the request'''
+    if not has_app_context():
+        yield
+        return
+    depth = getattr(g, 'cart_uncounted', 0)
+    g.cart_uncounted = depth + 1
+    try:
+        yield
+    finally:
+        g.cart_uncounted = depth
+
+@cart.before_app_first_request
+def install_read_counter():
+    count_record_reads()
+
+def render_template(template_name, **context):
+    '''Render a template and count the render time of the request'''
+    start = time.time()
+    try:
+        return flask_render_template(template_name, **context)
+    finally:
+        count_metric('render_seconds', time.time() - start)
+
+@cart.before_request
+def start_metrics():
+    g.cart_stats = {}
+    g.cart_start = time.time()
+
+@cart.after_request
+def record_metrics(response):
+    start = getattr(g, 'cart_start', None)
+    if start is None:
+        return response
+    seconds = time.time() - start
+    CART_METRICS.observe(request.endpoint, seconds, g.cart_stats)
+    if CART_METRICS_LOG:
+        stats = dict(g.cart_stats)
+        stats['endpoint'] = request.endpoint
+        stats['seconds'] = seconds
+        stats['status'] = response.status_code
+        current_app.logger.info('Cart. Metrics %s' % json.dumps(stats))
+    return response
+
+def orm_calls():
+    '''Return the ORM calls of the current request'''
+    stats = getattr(g, 'cart_stats', None) or {}
+    return sum(v for k, v in stats.iteritems() if k.startswith('orm_'))
+
+def check_query_budget(name, calls, limit, log=False):
+    '''Raise or log (TRYTON_CART_QUERY_BUDGET) when calls is over limit.
+    Budgets raise by default in debug and testing mode; with log they are
+    only logged'''
+    if not QUERY_BUDGET_MODE or calls <= limit:
+        return
+    message = 'Cart. %s ORM calls in %s (budget %s)' % (calls, name, limit)
+    if QUERY_BUDGET_MODE == 'raise' and not log:
+        raise QueryBudgetExceeded(message)
+    current_app.logger.warning(message)
+
+
+class query_budget(object):
+    "Check the ORM calls of a block or a function (context manager/decorator)"
+
+    def __init__(self, limit, name=None):
+        self.limit = limit
+        self.name = name
+
+    def __enter__(self):
+        if getattr(g, 'cart_stats', None) is None:
+            g.cart_stats = {}
+        self._start = orm_calls()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            check_query_budget(self.name, orm_calls() - self._start,
+                self.limit)
+
+    def __call__(self, func):
+        name = self.name or func.__name__
+
+        def wrapper(*args, **kwargs):
+            with query_budget(self.limit, name):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+def count_cart_lines(lines):
+    '''Record the cart lines handled by the request (the largest count) for
+    the per line allowance of QUERY_BUDGETS. Unlike g.cart_ids it is kept
+    when carts are written'''
+    g.cart_lines = max(getattr(g, 'cart_lines', 0), lines)
+
+@cart.after_request
+def check_request_budget(response):
+    '''Check the ORM calls of the view with QUERY_BUDGETS.
+    Calls of before_request hooks (merge_carts) are not in the budget.
+    The transaction of the view is committed before this hook, so budgets of
+    writing requests (not GET) are only logged: raising would answer an error
+    for a cart or sale already saved'''
+    budget = QUERY_BUDGETS.get(request.endpoint)
+    if budget and getattr(g, 'cart_stats', None) is not None:
+        calls, line_calls = budget
+        lines = getattr(g, 'cart_lines', 0)
+        check_query_budget(request.endpoint,
+            orm_calls() - getattr(g, 'cart_budget_start', 0),
+            calls + line_calls * lines,
+            log=request.method not in ('GET', 'HEAD'))
+    return response
+
+@cart.route('/metrics', methods=['GET'], endpoint="metrics")
+def metrics(lang):
+    '''Cart metrics (Prometheus text format)'''
+    if not CART_METRICS_ENABLED:
+        abort(404)
+    return current_app.response_class(CART_METRICS.prometheus(),
+        mimetype='text/plain; version=0.0.4')
+
 GALATEA_WEBSITE = current_app.config.get('TRYTON_GALATEA_SITE')
 SHOP = current_app.config.get('TRYTON_SALE_SHOP')
 SHOPS = current_app.config.get('TRYTON_SALE_SHOPS')
 CART_CROSSSELLS = current_app.config.get('TRYTON_CART_CROSSSELLS', True)
 LIMIT_CROSSELLS = current_app.config.get('TRYTON_CATALOG_LIMIT_CROSSSELLS', 10)
 MINI_CART_CODE = current_app.config.get('TRYTON_CATALOG_MINI_CART_CODE', False)
-
-Website = tryton.pool.get('galatea.website')
-GalateaUser = tryton.pool.get('galatea.user')
-Cart = tryton.pool.get('sale.cart')
-Template = tryton.pool.get('product.template')
-Product = tryton.pool.get('product.product')
-Shop = tryton.pool.get('sale.shop')
-Carrier = tryton.pool.get('carrier')
-Party = tryton.pool.get('party.party')
-Address = tryton.pool.get('party.address')
-Sale = tryton.pool.get('sale.sale')
-SaleLine = tryton.pool.get('sale.line')
-Country = tryton.pool.get('country.country')
-Subdivision = tryton.pool.get('country.subdivision')
-Carrier = tryton.pool.get('carrier')
-PaymentType = tryton.pool.get('account.payment.type')
+CART_DEFERRED = current_app.config.get('TRYTON_CART_DEFERRED', False)
+CARRIER_CACHE_SIZE = current_app.config.get('TRYTON_CART_CARRIER_CACHE_SIZE', 1024)
+CARRIER_CACHE_TIMEOUT = current_app.config.get('TRYTON_CART_CARRIER_CACHE_TIMEOUT', 300)
+CART_DEFAULTS_CACHE_TIMEOUT = current_app.config.get('TRYTON_CART_DEFAULTS_CACHE_TIMEOUT', 3600)
+WEBSITE_CACHE_TIMEOUT = current_app.config.get('TRYTON_CART_WEBSITE_CACHE_TIMEOUT', 3600)
+SHOP_CACHE_TIMEOUT = current_app.config.get('TRYTON_CART_SHOP_CACHE_TIMEOUT', 3600)
+THUMBNAIL_CACHE_SIZE = current_app.config.get('TRYTON_CART_THUMBNAIL_CACHE_SIZE', 10000)
+WARM_THUMBNAILS = current_app.config.get('TRYTON_CART_WARM_THUMBNAILS', False)
+CROSSSELLS_CACHE_TIMEOUT = current_app.config.get('TRYTON_CART_CROSSSELLS_CACHE_TIMEOUT', 3600)
+STOCK_CACHE_TIMEOUT = current_app.config.get('TRYTON_CART_STOCK_CACHE_TIMEOUT', 0)
+MINI_CART_CACHE_SIZE = current_app.config.get('TRYTON_CART_MINI_CART_CACHE_SIZE', 4096)
+MINI_CART_CACHE_TIMEOUT = current_app.config.get('TRYTON_CART_MINI_CART_CACHE_TIMEOUT', 300)
+ZIP_CACHE_TIMEOUT = current_app.config.get('TRYTON_CART_ZIP_CACHE_TIMEOUT', 3600)
+QUOTE_DEFERRED = current_app.config.get('TRYTON_CART_QUOTE_DEFERRED', False)
+QUOTE_RETRIES = current_app.config.get('TRYTON_CART_QUOTE_RETRIES', 5)
+QUOTE_RETRY_DELAY = current_app.config.get('TRYTON_CART_QUOTE_RETRY_DELAY', 2)
+QUOTE_RECOVER_HOURS = current_app.config.get('TRYTON_CART_QUOTE_RECOVER_HOURS', 24)
+QUOTE_LEASE = current_app.config.get('TRYTON_CART_QUOTE_LEASE', 600)
+CARRIER_WORKERS = current_app.config.get('TRYTON_CART_CARRIER_WORKERS', 0)
+CARRIER_TIMEOUT = current_app.config.get('TRYTON_CART_CARRIER_TIMEOUT', 5)
+CART_METRICS_ENABLED = current_app.config.get('TRYTON_CART_METRICS', False)
+CART_METRICS_LOG = current_app.config.get('TRYTON_CART_METRICS_LOG', False)
+QUERY_BUDGET_MODE = current_app.config.get('TRYTON_CART_QUERY_BUDGET',
+    'raise' if current_app.debug or current_app.testing else None)
+DATABASE = current_app.config.get('TRYTON_DATABASE')
+READ_DATABASE = current_app.config.get('TRYTON_CART_READ_DATABASE')
+READ_LAG = current_app.config.get('TRYTON_CART_READ_LAG', 5)
+CARRIER_PRICE_BANDS = sorted(Decimal(str(b)) for b in
+    current_app.config.get('TRYTON_CART_CARRIER_PRICE_BANDS', []))
+
+Website = ModelProxy('galatea.website')
+GalateaUser = ModelProxy('galatea.user')
+Cart = ModelProxy('sale.cart')
+Template = ModelProxy('product.template')
+Product = ModelProxy('product.product')
+Shop = ModelProxy('sale.shop')
+Carrier = ModelProxy('carrier')
+Party = ModelProxy('party.party')
+Address = ModelProxy('party.address')
+Sale = ModelProxy('sale.sale')
+SaleLine = ModelProxy('sale.line')
+Country = ModelProxy('country.country')
+Subdivision = ModelProxy('country.subdivision')
+PaymentType = ModelProxy('account.payment.type')
 
 PRODUCT_TYPE_STOCK = ['goods', 'assets']
 CART_ORDER = [
@@ -43,9 +363,267 @@ CART_ORDER = [
     ('id', 'DESC'),
     ]
 
-VAT_COUNTRIES = [('', '')]
-for country in vatnumber.countries():
-    VAT_COUNTRIES.append((country, country))
+CART_ARCHIVE_FIELDS = ['id', 'sid', 'party', 'product', 'quantity',
+    'unit_price', 'cart_date']
+CART_INDEXES = [
+    ('sale_cart_state_shop_sid_index', ('state', 'shop', 'sid')),
+    ('sale_cart_state_shop_galatea_user_index',
+        ('state', 'shop', 'galatea_user')),
+    ]
+
+VAT_COUNTRIES = None
+
+
+class LRUCache(object):
+    "Bounded in-process cache with time to live and LRU eviction"
+
+    def __init__(self, size=1024, timeout=300):
+        self.size = size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expire, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expire and expire < time.time():
+                return default
+            self._data[key] = (expire, value)
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + timeout if timeout else None,
+                value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class PhaseTimer(object):
+    "Elapsed time of consecutive phases"
+
+    def __init__(self):
+        self.timings = OrderedDict()
+        self._start = time.time()
+
+    def mark(self, name):
+        '''Record the time since the previous mark as phase name'''
+        now = time.time()
+        self.timings[name] = now - self._start
+        self._start = now
+
+    def __str__(self):
+        return ', '.join('%s: %.3fs' % (k, v)
+            for k, v in self.timings.iteritems())
+
+
+
+class QuoteQueue(object):
+    "Background queue that quotes sales out of the request. " \
+        "Enqueued sales are recorded in the galatea_cart_quote table"
+    table = Table('galatea_cart_quote')
+
+    def __init__(self, retries=5, delay=2):
+        self.retries = retries
+        self.delay = delay
+        self.processed = 0
+        self.failed = 0
+        self.app = None
+        self._queue = Queue.Queue()
+        self._enqueued = {} # sale id: enqueue time
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, app):
+        '''Start the worker thread (once by process)'''
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self.app = app
+            self._thread = threading.Thread(target=self._run,
+                name='galatea-cart-quote')
+            self._thread.daemon = True
+            self._thread.start()
+
+    @property
+    def owner(self):
+        '''Return the owner of the sales enqueued by this process'''
+        return '%s:%s' % (socket.gethostname(), os.getpid())
+
+    @staticmethod
+    def commit(transaction):
+        if hasattr(transaction, 'commit'):
+            transaction.commit()
+        else:
+            transaction.cursor.commit()
+
+    def record(self, sale_id):
+        '''Record a sale to quote in the current transaction.
+        Call it in the transaction that creates the sale, so the record is
+        committed with the sale'''
+        table = self.table
+        transaction_cursor().execute(*table.insert(
+                [table.sale, table.state, table.owner, table.enqueued],
+                [[sale_id, 'pending', self.owner, datetime.now()]]))
+
+    def enqueue(self, sale_id, attempt=0):
+        with self._lock:
+            self._enqueued.setdefault(sale_id, time.time())
+        self._queue.put((sale_id, attempt))
+
+    def metrics(self):
+        '''Return queue depth, lag (seconds of the oldest sale), processed
+        and failed sales'''
+        now = time.time()
+        with self._lock:
+            enqueued = self._enqueued.values()
+        return {
+            'depth': len(enqueued),
+            'lag': now - min(enqueued) if enqueued else 0,
+            'processed': self.processed,
+            'failed': self.failed,
+            }
+
+    def quote(self, sale_id):
+        '''Quote a sale in a new transaction and remove its record.
+        A sale recorded by another process (recovered) is skipped'''
+        table = self.table
+        user = int(self.app.config.get('TRYTON_USER', 0))
+        with database_transaction(DATABASE, user) as transaction:
+            cursor = transaction_cursor()
+            cursor.execute(*table.delete(where=(table.sale == sale_id)
+                    & (table.owner == self.owner)))
+            if cursor.rowcount != 1:
+                return
+            Sale.quote([Sale(sale_id)])
+            self.commit(transaction)
+
+    def fail(self, sale_id):
+        '''Mark the record of a sale as failed (it is not recovered)'''
+        table = self.table
+        user = int(self.app.config.get('TRYTON_USER', 0))
+        with database_transaction(DATABASE, user) as transaction:
+            transaction_cursor().execute(*table.update([table.state],
+                    ['failed'], where=(table.sale == sale_id)
+                    & (table.owner == self.owner)))
+            self.commit(transaction)
+
+    def recover(self):
+        '''Enqueue pending sales of the last QUOTE_RECOVER_HOURS not handled
+        by their process in QUOTE_LEASE seconds (a stopped process).
+        Each sale is claimed by one process'''
+        table = self.table
+        user = int(self.app.config.get('TRYTON_USER', 0))
+        now = datetime.now()
+        sale_ids = []
+        with database_transaction(DATABASE, user) as transaction:
+            cursor = transaction_cursor()
+            cursor.execute(*table.select(table.sale, table.enqueued,
+                    where=(table.state == 'pending')
+                    & (table.enqueued < now - timedelta(seconds=QUOTE_LEASE))
+                    & (table.enqueued >= now - timedelta(
+                            hours=QUOTE_RECOVER_HOURS))))
+            for sale_id, enqueued in cursor.fetchall():
+                cursor.execute(*table.update([table.owner, table.enqueued],
+                        [self.owner, now], where=(table.sale == sale_id)
+                        & (table.enqueued == enqueued)
+                        & (table.state == 'pending')))
+                if cursor.rowcount == 1:
+                    sale_ids.append(sale_id)
+            self.commit(transaction)
+        for sale_id in sale_ids:
+            self.enqueue(sale_id)
+
+    def _done(self, sale_id):
+        with self._lock:
+            self._enqueued.pop(sale_id, None)
+
+    def _run(self):
+        with self.app.app_context():
+            try:
+                self.recover()
+            except Exception as e:
+                self.app.logger.error('Sale. Error recover quote queue: %s' % e)
+            while True:
+                sale_id, attempt = self._queue.get()
+                try:
+                    self.quote(sale_id)
+                except Exception as e:
+                    if attempt < self.retries:
+                        delay = self.delay * 2 ** attempt
+                        self.app.logger.warning('Sale. Error quote sale %s '
+                            '(retry in %ss): %s' % (sale_id, delay, e))
+                        timer = threading.Timer(delay, self.enqueue,
+                            [sale_id, attempt + 1])
+                        timer.daemon = True
+                        timer.start()
+                    else:
+                        self.failed += 1
+                        self._done(sale_id)
+                        self.app.logger.error('Sale. Error quote sale %s: %s'
+                            % (sale_id, e))
+                        try:
+                            self.fail(sale_id)
+                        except Exception as e:
+                            self.app.logger.error('Sale. Error mark sale %s '
+                                'as failed: %s' % (sale_id, e))
+                else:
+                    self.processed += 1
+                    self._done(sale_id)
+
+QUOTE_QUEUE = QuoteQueue(QUOTE_RETRIES, QUOTE_RETRY_DELAY)
+CARRIER_CACHE = LRUCache(CARRIER_CACHE_SIZE, CARRIER_CACHE_TIMEOUT)
+CARRIER_POOL = None
+READ_POOL_LOCK = threading.Lock()
+TRANSACTION_DATABASE = threading.local() # database of replica transactions
+ZIP_CACHE = LRUCache(10000, ZIP_CACHE_TIMEOUT)
+SHOP_CACHE = LRUCache(64, SHOP_CACHE_TIMEOUT)
+WEBSITE_CACHE = LRUCache(16, WEBSITE_CACHE_TIMEOUT)
+CART_DEFAULTS_CACHE = LRUCache(64, CART_DEFAULTS_CACHE_TIMEOUT)
+STOCK_CACHE = LRUCache(10000, STOCK_CACHE_TIMEOUT)
+CROSSSELLS_CACHE = LRUCache(10000, CROSSSELLS_CACHE_TIMEOUT)
+THUMBNAIL_CACHE = LRUCache(THUMBNAIL_CACHE_SIZE, 0)
+CART_SUMMARY_CACHE = LRUCache(MINI_CART_CACHE_SIZE, MINI_CART_CACHE_TIMEOUT)
+# Rendered mini cart and user cart versions. TRYTON_CART_MINI_CART_CACHE
+# accepts any cache object with get(key) and set(key, value, timeout)
+# (werkzeug Redis cache,...). The default cache is per process, so the user
+# cart version only spans the sessions served by the same process
+MINI_CART_CACHE = current_app.config.get('TRYTON_CART_MINI_CART_CACHE') or \
+    LRUCache(MINI_CART_CACHE_SIZE, MINI_CART_CACHE_TIMEOUT)
+
+
+WebsiteConfig = namedtuple('WebsiteConfig', [
+    'id',
+    'esale_stock',
+    'esale_stock_qty',
+    ])
+ShopConfig = namedtuple('ShopConfig', [
+    'id',
+    'currency_digits',
+    'currency_symbol',
+    'country', # (id, code)
+    'countries', # ((id, name),)
+    'payment_ids',
+    'carrier_ids',
+    'delivery_product',
+    ])
 
 
 class ShipmentAddressForm(Form):
@@ -92,108 +670,537 @@ class InvoiceAddressForm(Form):
             return False
         return True
 
-def get_carriers(shop, party=None, untaxed=0, tax=0, total=0, payment=None):
-    '''Return carriers and calculate delivery price from a virtual sale'''
+def website_config():
+    '''Return the website settings snapshot (WebsiteConfig) or None when the
+    website is not found. Snapshots are refreshed after
+    TRYTON_CART_WEBSITE_CACHE_TIMEOUT seconds or invalidate_website_config()'''
+    config = WEBSITE_CACHE.get(GALATEA_WEBSITE)
+    if config is not None:
+        return config or None
+
+    websites = Website.search([
+        ('id', '=', GALATEA_WEBSITE),
+        ], limit=1)
+    if websites:
+        website, = websites
+        config = WebsiteConfig(
+            id=website.id,
+            esale_stock=website.esale_stock,
+            esale_stock_qty=website.esale_stock_qty,
+            )
+    else:
+        config = False
+    WEBSITE_CACHE.set(GALATEA_WEBSITE, config)
+    return config or None
+
+def invalidate_website_config():
+    '''Remove the website settings snapshot (call when the website changes)'''
+    WEBSITE_CACHE.clear()
+
+def vat_countries():
+    '''Return VAT country choices (built on first use)'''
+    global VAT_COUNTRIES
+    if VAT_COUNTRIES is None:
+        VAT_COUNTRIES = [('', '')] + [(country, country)
+            for country in vatnumber.countries()]
+    return VAT_COUNTRIES
+
+def init_app(app):
+    '''Resolve models and static tables of the blueprint, install the
+    record read counter, warm thumbnails (TRYTON_CART_WARM_THUMBNAILS) and,
+    with TRYTON_CART_QUOTE_DEFERRED, start the quote queue (it recovers
+    pending sales). Models are resolved on first use; call it to warm up
+    workers before forking or serving requests'''
+    with app.app_context():
+        for proxy in ModelProxy.proxies:
+            proxy.resolve()
+        vat_countries()
+        if READ_DATABASE:
+            init_read_pool()
+        if WARM_THUMBNAILS:
+            warm_thumbnails()
+    count_record_reads()
+    if QUOTE_DEFERRED:
+        QUOTE_QUEUE.start(app)
+
+def init_read_pool():
+    '''Initialize the Tryton pool of TRYTON_CART_READ_DATABASE (once by
+    process). Models resolve Pool() from the transaction database, so
+    relations and getters of a replica transaction need its own pool'''
+    if READ_DATABASE in Pool.database_list():
+        return
+    with READ_POOL_LOCK:
+        if READ_DATABASE not in Pool.database_list():
+            with Transaction().start(READ_DATABASE, 0, readonly=True):
+                Pool(READ_DATABASE).init()
+
+def read_database():
+    '''Return the database of read only transactions.
+    Sessions that wrote carts in the last TRYTON_CART_READ_LAG seconds read
+    from the primary, so they do not see a replica behind their writes'''
+    if not READ_DATABASE or \
+            time.time() - session.get('cart_written', 0) < READ_LAG:
+        return DATABASE
+    return READ_DATABASE
+
+def transaction_cursor():
+    '''Return a cursor of the current transaction'''
+    transaction = Transaction()
+    if hasattr(transaction, 'connection'):
+        return transaction.connection.cursor()
+    return transaction.cursor
+
+def transaction_database():
+    '''Return the database of the cart transaction of the current thread'''
+    return getattr(TRANSACTION_DATABASE, 'name', None) or DATABASE
+
+@contextmanager
+def database_transaction(database, user, readonly=False):
+    '''Start a transaction on database with the galatea default context
+    (tryton.context_callback) and resolve cart models from its pool'''
+    context = {}
+    context_callback = getattr(tryton, 'context_callback', None)
+    if context_callback:
+        with Transaction().start(database, user, readonly=True):
+            context = context_callback()
+    previous = getattr(TRANSACTION_DATABASE, 'name', None)
+    TRANSACTION_DATABASE.name = database
+    try:
+        with Transaction().start(database, user, readonly=readonly,
+                context=context) as transaction:
+            yield transaction
+    finally:
+        TRANSACTION_DATABASE.name = previous
+
+def read_transaction(func):
+    '''Run a view in a read only transaction.
+    With TRYTON_CART_READ_DATABASE the transaction is opened on the read
+    replica database; writes (add, checkout, confirm) stay on the primary'''
+    primary = tryton.transaction(readonly=True)(func)
+
+    def wrapper(*args, **kwargs):
+        database = read_database()
+        if database == DATABASE:
+            return primary(*args, **kwargs)
+        init_read_pool()
+        count_metric('read_replica_transactions')
+        user = int(current_app.config.get('TRYTON_USER', 0))
+        with database_transaction(database, user, readonly=True):
+            return func(*args, **kwargs)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+def shop_config(shop_id=None):
+    '''Return the shop configuration snapshot (ShopConfig).
+    Snapshots are loaded once by worker and language and refreshed after
+    TRYTON_CART_SHOP_CACHE_TIMEOUT seconds or invalidate_shop_config()
+    (call it when the shop, its payments or its list of carriers change)'''
+    shop_id = shop_id or SHOP
+    key = (shop_id, Transaction().language)
+    config = SHOP_CACHE.get(key)
+    if config is not None:
+        return config
+
+    shop = Shop(shop_id)
+    carriers = [c.carrier for c in shop.esale_carriers]
+    country = shop.esale_country
+    config = ShopConfig(
+        id=shop.id,
+        currency_digits=shop.esale_currency.digits,
+        currency_symbol=shop.esale_currency.symbol,
+        country=(country.id, country.code) if country else (None, None),
+        countries=tuple((c.id, c.name) for c in shop.esale_countrys),
+        payment_ids=tuple(p.payment_type.id for p in shop.esale_payments),
+        carrier_ids=tuple(c.id for c in carriers),
+        delivery_product=(shop.esale_delivery_product.id
+            if shop.esale_delivery_product else None),
+        )
+    SHOP_CACHE.set(key, config)
+    return config
+
+def carriers_stamp(config=None):
+    '''Return the last write date of the shop carriers.
+    Read live (one read by request), so carrier quotes and the zip index
+    are refreshed when a carrier changes inside the shop snapshot'''
+    config = config or shop_config()
+    stamps = getattr(g, 'cart_carriers_stamp', None)
+    if stamps is None:
+        stamps = g.cart_carriers_stamp = {}
+    if config.id not in stamps:
+        values = Carrier.read(list(config.carrier_ids),
+            ['write_date', 'create_date'])
+        stamps[config.id] = max([v['write_date'] or v['create_date']
+                for v in values] or [None])
+    return stamps[config.id]
+
+def invalidate_shop_config():
+    '''Remove shop configuration snapshots (call when shops change)'''
+    SHOP_CACHE.clear()
+    CARRIER_CACHE.clear()
+
+def price_band(amount):
+    '''Return the price band of an amount.
+    Without TRYTON_CART_CARRIER_PRICE_BANDS the exact amount is the band'''
+    amount = Decimal(amount or 0)
+    if not CARRIER_PRICE_BANDS:
+        return amount
+    return bisect_right(CARRIER_PRICE_BANDS, amount)
+
+def invalidate_carrier_cache():
+    '''Remove all carrier quotes (call when carriers or shops change)'''
+    CARRIER_CACHE.clear()
+
+def zip_carrier_ids(zip):
+    '''Return the ids of carriers that deliver to a zip (frozenset).
+    The zip index is refreshed when carriers change, after
+    TRYTON_CART_ZIP_CACHE_TIMEOUT seconds or invalidate_zip_carriers()'''
+    key = (zip, carriers_stamp())
+    carrier_ids = ZIP_CACHE.get(key)
+    if carrier_ids is None:
+        carrier_ids = frozenset(c.id
+            for c in Carrier.get_carriers_from_zip(zip))
+        ZIP_CACHE.set(key, carrier_ids)
+    return carrier_ids
+
+def invalidate_zip_carriers():
+    '''Remove the zip index (call when carrier zones change)'''
+    ZIP_CACHE.clear()
+
+def carrier_cache_key(shop, party=None, untaxed=0, tax=0, total=0,
+        payment=None, carrier_ids=None):
+    '''Return the carrier quote cache key.
+    Last write date of the carriers (read live) and of the party carrier are
+    part of the key so quotes are invalidated when any of these records
+    change; shop changes need invalidate_shop_config()'''
+    config = shop_config(shop.id)
+    party_carrier = getattr(party, 'carrier', None) if party else None
+    if isinstance(payment, (int, long)):
+        payment_id = payment
+    else:
+        payment_id = payment.id if payment else None
+    stamps = [carriers_stamp(config)]
+    if party_carrier:
+        stamps.append(party_carrier.write_date or party_carrier.create_date)
+    return (
+        config.id,
+        party.id if party else None,
+        party_carrier.id if party_carrier else None,
+        payment_id,
+        price_band(untaxed),
+        price_band(tax),
+        price_band(total),
+        max(stamps),
+        carrier_ids,
+        )
+
+def get_carriers(shop, party=None, untaxed=0, tax=0, total=0, payment=None,
+        carrier_ids=None):
+    '''Return carriers and calculate delivery price from a virtual sale.
+    Quotes are cached by shop, party, payment and amounts (or price bands).
+    Partial quotes (carriers that timed out or failed) are not cached.
+    carrier_ids restricts the carriers to price (all carriers by default)'''
+    key = carrier_cache_key(shop, party, untaxed, tax, total, payment,
+        carrier_ids)
+    carriers = CARRIER_CACHE.get(key)
+    if carriers is None:
+        carriers, complete = compute_carriers(shop, party, untaxed, tax,
+            total, payment, carrier_ids)
+        if complete:
+            CARRIER_CACHE.set(key, carriers)
+    return [c.copy() for c in carriers]
+
+def carrier_price(carrier_id, party_id=None, untaxed=0, tax=0, total=0,
+        payment_id=None):
+    '''Return carrier price and price with taxes from a virtual sale'''
+    carrier = Carrier(carrier_id)
+    party = Party(party_id) if party_id else None
     sale = Sale()
     sale.untaxed_amount = untaxed
     sale.tax_amount = tax
     sale.total_amount = total
-    if isinstance(payment, int):
-        sale.payment_type = PaymentType(payment)
-    else:
-        sale.payment_type = payment
+    sale.payment_type = PaymentType(payment_id) if payment_id else None
+    sale.carrier = carrier
 
     context = {}
     context['record'] = sale # Eval by "carrier formula" require "record"
+    context['carrier'] = carrier
+    with uncounted_reads():
+        with Transaction().set_context(context):
+            sale_price = carrier.get_sale_price() # return price, currency
+        price = sale_price[0]
+        price_w_tax = carrier.get_sale_price_w_tax(price, party=party)
+    return price, price_w_tax
 
+def _carrier_price_worker(database, user, context, *args):
+    '''Calculate a carrier price in a new read only transaction'''
+    TRANSACTION_DATABASE.name = database
+    try:
+        with Transaction().start(database, user, readonly=True,
+                context=context):
+            return carrier_price(*args)
+    finally:
+        TRANSACTION_DATABASE.name = None
+
+def carrier_pool():
+    '''Return the thread pool of carrier prices (created on first use)'''
+    global CARRIER_POOL
+    if CARRIER_POOL is None:
+        CARRIER_POOL = ThreadPool(CARRIER_WORKERS)
+    return CARRIER_POOL
+
+def carrier_prices(carrier_ids, party_id=None, untaxed=0, tax=0, total=0,
+        payment_id=None):
+    '''Return carrier prices {carrier id: (price, price_w_tax)}.
+    With TRYTON_CART_CARRIER_WORKERS prices are calculated concurrently and
+    carriers that not finish in TRYTON_CART_CARRIER_TIMEOUT seconds are
+    discarded'''
+    args = (party_id, untaxed, tax, total, payment_id)
+    count_metric('carrier_evaluations', len(carrier_ids))
+    if not CARRIER_WORKERS or len(carrier_ids) < 2:
+        return dict((c, carrier_price(c, *args)) for c in carrier_ids)
+
+    transaction = Transaction()
+    database = transaction_database()
+    pool = carrier_pool()
+    results = [(c, pool.apply_async(_carrier_price_worker,
+                (database, transaction.user, dict(transaction.context), c)
+                + args))
+        for c in carrier_ids]
+
+    prices = {}
+    deadline = time.time() + CARRIER_TIMEOUT
+    for carrier_id, result in results:
+        try:
+            prices[carrier_id] = result.get(max(deadline - time.time(), 0))
+        except TimeoutError:
+            current_app.logger.warning(
+                'Carrier. Timeout calculate price of carrier %s' % carrier_id)
+        except Exception as e:
+            current_app.logger.error(
+                'Carrier. Error calculate price of carrier %s: %s' % (
+                    carrier_id, e))
+    return prices
+
+def compute_carriers(shop, party=None, untaxed=0, tax=0, total=0,
+        payment=None, carrier_ids=None):
+    '''Calculate delivery price of carriers from a virtual sale.
+    Return a tuple (carriers, complete); complete is False when a carrier
+    price is missing (timeout or error)'''
+    config = shop_config(shop.id)
+    decimals = "%0."+str(config.currency_digits)+"f" # "%0.2f" euro
+
+    # Party carrier first, then shop carriers
     carriers = []
-    decimals = "%0."+str(shop.esale_currency.digits)+"f" # "%0.2f" euro
-    default_party = None
+    default_party = getattr(party, 'carrier', None) if party else None
+    if default_party:
+        carriers.append(default_party)
+    for carrier in Carrier.browse(list(config.carrier_ids)):
+        if carrier != default_party:
+            carriers.append(carrier)
+    if carrier_ids is not None:
+        carriers = [c for c in carriers if c.id in carrier_ids]
+
+    if isinstance(payment, (int, long)):
+        payment_id = payment
+    else:
+        payment_id = payment.id if payment else None
+    prices = carrier_prices([c.id for c in carriers],
+        party.id if party else None, untaxed, tax, total, payment_id)
 
-    if party:
-        if hasattr(party, 'carrier'):
-            carrier = party.carrier
-            if carrier:
-                sale.carrier = carrier
-                context['carrier'] = carrier
-                with Transaction().set_context(context):
-                    carrier_price = carrier.get_sale_price() # return price, currency
-                price = carrier_price[0]
-                price_w_tax = carrier.get_sale_price_w_tax(price, party=party)
-                carriers.append({
-                    'id': party.carrier.id,
-                    'name': party.carrier.rec_name,
-                    'price': float(Decimal(decimals % price)),
-                    'price_w_tax': float(Decimal(decimals % price_w_tax)),
-                    })
-                default_party = party.carrier
-
-    for c in shop.esale_carriers:
-        carrier = c.carrier
-        if carrier == default_party:
+    result = []
+    for carrier in carriers:
+        if carrier.id not in prices:
             continue
-
-        sale.carrier = carrier
-        context['carrier'] = carrier
-        with Transaction().set_context(context):
-            carrier_price = carrier.get_sale_price() # return price, currency
-        price = carrier_price[0]
-        price_w_tax = carrier.get_sale_price_w_tax(price, party=party)
-        carriers.append({
+        price, price_w_tax = prices[carrier.id]
+        result.append({
             'id': carrier.id,
             'name': carrier.rec_name,
             'price': float(Decimal(decimals % price)),
             'price_w_tax': float(Decimal(decimals % price_w_tax)),
             })
 
-    return sorted(carriers, key=lambda k: k['price'])
+    return (sorted(result, key=lambda k: k['price']),
+        len(result) == len(carriers))
+
+def cart_summary(carts=None):
+    '''Return totals of the current user or session carts: untaxed_amount,
+    tax_amount, total_amount, product_ids, template_ids and stockable.
+    Carts are read in bulk and the summary is cached by the session and user
+    cart versions'''
+    user = session.get('user')
+    key = ('summary', session.sid, user, cart_version(),
+        user_cart_version(user), SHOP)
+    summary = CART_SUMMARY_CACHE.get(key)
+    if summary is not None:
+        return summary
+
+    if carts is None:
+        carts = session_carts()
 
+    untaxed_amount = Decimal(0)
+    tax_amount = Decimal(0)
+    total_amount = Decimal(0)
+    product_ids = []
+    values = Cart.read([c.id for c in carts],
+        ['product', 'untaxed_amount', 'amount_w_tax'])
+    for value in values:
+        if value['product'] not in product_ids:
+            product_ids.append(value['product'])
+        untaxed_amount += value['untaxed_amount']
+        tax_amount += value['amount_w_tax'] - value['untaxed_amount']
+        total_amount += value['amount_w_tax']
+    template_ids = list({v['template']
+        for v in Product.read(product_ids, ['template'])})
+
+    summary = {
+        'untaxed_amount': untaxed_amount,
+        'tax_amount': tax_amount,
+        'total_amount': total_amount,
+        'product_ids': product_ids,
+        'template_ids': template_ids,
+        'stockable': Carrier.get_products_stockable(product_ids),
+        }
+    CART_SUMMARY_CACHE.set(key, summary)
+    return summary
 
 @cart.route('/carriers', methods=['GET'], endpoint="carriers")
-@tryton.transaction()
+@read_transaction
 def carriers(lang):
     '''Return all carriers (JSON)'''
     zip = request.args.get('zip', None)
-    untaxed = request.args.get('untaxed', None)
-    tax = request.args.get('tax', None)
-    total = request.args.get('total', None)
     payment = request.args.get('payment', None)
 
     customer = session.get('customer', None)
 
+    # Amounts are computed from the carts, not trusted from the request
+    summary = cart_summary()
+
     shop = Shop(SHOP)
     carriers = get_carriers(
         shop=shop,
         party=Party(customer) if customer else None,
-        untaxed=Decimal(untaxed) if untaxed else 0,
-        tax=Decimal(tax) if tax else 0,
-        total=Decimal(total) if total else 0,
-        payment=int(payment) if untaxed else None,
+        untaxed=summary['untaxed_amount'],
+        tax=summary['tax_amount'],
+        total=summary['total_amount'],
+        payment=int(payment) if payment else None,
+        carrier_ids=zip_carrier_ids(zip) if zip else None,
         )
 
-    if zip:
-        zip_carriers = []
-        for carrier in Carrier.get_carriers_from_zip(zip):
-            for c in carriers:
-                if carrier.id == c['id']:
-                    zip_carriers.append(c)
-                    break
-        carriers = sorted(zip_carriers, key=lambda k: k['price'])
-
     return jsonify(result=carriers)
 
-@cart.route('/json/my-cart', methods=['GET', 'PUT'], endpoint="my-cart")
-@tryton.transaction()
-def my_cart(lang):
-    '''All Carts JSON'''
-    items = []
-
-    shop = Shop(SHOP)
+def cart_thumbnail(img, size='200x200'):
+    '''Return the thumbnail URL of a small esale default image.
+    URLs are memoized by (digest, size), so the image is only resized
+    and checked in the filesystem once by worker'''
+    if not img or not img.get('small'):
+        return current_app.config.get('BASE_IMAGE')
+    filename = img['small']['digest']
+    key = (filename, size)
+    url = THUMBNAIL_CACHE.get(key)
+    if url is None:
+        url = thumbnail(filename, img['small']['name'], size)
+        THUMBNAIL_CACHE.set(key, url)
+    return url
+
+@tryton.transaction(readonly=True)
+def warm_thumbnails(size='200x200', chunk=500):
+    '''Generate cart thumbnails of all esale available templates of the shop.
+    Files are generated once, but URLs are memoized by process, so it is run
+    by init_app with TRYTON_CART_WARM_THUMBNAILS (before forking, workers
+    keep the memo). Return the number of thumbnails'''
+    templates = Template.search([
+        ('esale_available', '=', True),
+        ('shops', 'in', [SHOP]),
+        ])
+    template_ids = [t.id for t in templates]
+    total = 0
+    for i in range(0, len(template_ids), chunk):
+        for value in Template.read(template_ids[i:i + chunk],
+                ['esale_default_images']):
+            if value['esale_default_images'] and \
+                    value['esale_default_images'].get('small'):
+                cart_thumbnail(value['esale_default_images'], size)
+                total += 1
+    return total
+
+def load_mini_cart(carts):
+    '''Read carts, products and templates in bulk (one read by model).
+    Return a list of tuples (id, code, rec_name, slug, images, quantity,
+    unit_price, unit_price_w_tax, untaxed_amount, amount_w_tax)
+    in the same order of carts'''
+    if not carts:
+        return []
+    cart_ids = [c.id for c in carts]
+    cart_values = Cart.read(cart_ids, ['product', 'quantity', 'unit_price',
+        'unit_price_w_tax', 'untaxed_amount', 'amount_w_tax'])
+    cart_values = dict((v['id'], v) for v in cart_values)
+
+    product_ids = list({v['product'] for v in cart_values.itervalues()})
+    products = dict((v['id'], v) for v in Product.read(product_ids,
+        ['code', 'rec_name', 'template']))
+
+    template_ids = list({v['template'] for v in products.itervalues()})
+    templates = dict((v['id'], v) for v in Template.read(template_ids,
+        ['esale_slug', 'esale_default_images']))
+
+    lines = []
+    for cart_id in cart_ids:
+        cart = cart_values[cart_id]
+        product = products[cart['product']]
+        template = templates[product['template']]
+        lines.append((
+            cart_id,
+            product['code'],
+            product['rec_name'],
+            template['esale_slug'],
+            template['esale_default_images'],
+            cart['quantity'],
+            cart['unit_price'],
+            cart['unit_price_w_tax'],
+            cart['untaxed_amount'],
+            cart['amount_w_tax'],
+            ))
+    return lines
+
+def cart_version():
+    '''Return the cart version of the current session'''
+    return session.get('cart_version', 0)
+
+def bump_cart_version():
+    '''Increase the cart version of the current session.
+    Call it after create, write or delete carts'''
+    session['cart_version'] = cart_version() + 1
+    session['cart_written'] = time.time()
+    g.cart_ids = None
+    if session.get('user'):
+        MINI_CART_CACHE.set(user_cart_version_key(session['user']),
+            time.time(), 0)
+
+def user_cart_version_key(user):
+    return 'galatea-cart-user:%s' % user
+
+def user_cart_version(user):
+    '''Return the server side cart version of a user (last cart change).
+    User carts are shared by the sessions of the user, so a change in
+    another session changes this version. It is stored in MINI_CART_CACHE:
+    with the default per process cache a change served by another process is
+    only seen after TRYTON_CART_MINI_CART_CACHE_TIMEOUT seconds; set a shared
+    TRYTON_CART_MINI_CART_CACHE when the app runs on several processes'''
+    if not user:
+        return ''
+    return MINI_CART_CACHE.get(user_cart_version_key(user)) or ''
+
+def cart_domain():
+    '''Return the draft carts domain of the current user or session'''
     domain = [
         ('state', '=', 'draft'),
         ('shop', '=', SHOP),
         ]
-    if session.get('user'): # login user
+    if session.get('user') and session.get('cart_user') == session['user']:
+        # session carts are merged to the user
+        domain.append(('galatea_user', '=', session['user']))
+    elif session.get('user'): # login user
         domain.append(['OR', 
             ('sid', '=', session.sid),
             ('galatea_user', '=', session['user']),
@@ -202,41 +1209,295 @@ def my_cart(lang):
         domain.append(
             ('sid', '=', session.sid),
             )
+    return domain
+
+@tryton.transaction(readonly=False)
+def merge_session_carts():
+    '''Move the session carts to the login user.
+    Carts with the same product are collapsed, keeping the last cart.
+    Return the number of merged carts'''
+    user = session['user']
+    carts = Cart.search([
+        ('state', '=', 'draft'),
+        ('shop', '=', SHOP),
+        ['OR',
+            ('sid', '=', session.sid),
+            ('galatea_user', '=', user),
+            ],
+        ], order=CART_ORDER)
 
-    carts = Cart.search(domain, order=CART_ORDER)
-
-    decimals = "%0."+str(shop.esale_currency.digits)+"f" # "%0.2f" euro
+    to_write = []
+    to_delete = []
+    products = set()
     for cart in carts:
-        img = cart.product.template.esale_default_images
-        image = current_app.config.get('BASE_IMAGE')
-        if img.get('small'):
-            thumbname = img['small']['name']
-            filename = img['small']['digest']
-            image = thumbnail(filename, thumbname, '200x200')
+        if cart.product.id in products:
+            to_delete.append(cart)
+            continue
+        products.add(cart.product.id)
+        if not cart.galatea_user or cart.galatea_user.id != user:
+            to_write.append(cart)
+
+    if to_write:
+        Cart.write(to_write, {'galatea_user': user})
+    if to_delete:
+        Cart.delete(to_delete)
+    session['cart_user'] = user
+    if to_write or to_delete:
+        bump_cart_version()
+    return len(to_write) + len(to_delete)
+
+@cart.before_request
+def merge_carts():
+    '''Merge session carts once after login.
+    After logout the merge mark is removed, so anonymous carts are merged
+    again on the next login'''
+    if not session.get('user'):
+        session.pop('cart_user', None)
+    elif session.get('cart_user') != session['user']:
+        merge_session_carts()
+
+def session_cart_ids():
+    '''Return the cart ids of the current user or session (CART_ORDER).
+    Carts are searched once by request and stored in g'''
+    if getattr(g, 'cart_ids', None) is None:
+        g.cart_ids = [c.id for c in Cart.search(cart_domain(),
+            order=CART_ORDER)]
+        count_cart_lines(len(g.cart_ids))
+    return g.cart_ids
+
+def session_carts():
+    '''Return the cart records of the current user or session (CART_ORDER).
+    Records are browsed, so fields are only read when they are used'''
+    return Cart.browse(session_cart_ids())
+
+@tryton.transaction(readonly=False)
+def create_cart_indexes():
+    '''Create the sale_cart indexes used by the cart domain and the
+    galatea_cart_quote table of the deferred quote queue.
+    Run once on the database (IF NOT EXISTS); without the indexes the
+    OR (sid, galatea_user) search becomes a sequential scan'''
+    cursor = transaction_cursor()
+    cursor.execute('CREATE TABLE IF NOT EXISTS galatea_cart_quote ('
+        'sale INTEGER PRIMARY KEY, '
+        'state VARCHAR(16) NOT NULL, '
+        'owner VARCHAR(128) NOT NULL, '
+        'enqueued TIMESTAMP NOT NULL)')
+    for name, columns in CART_INDEXES:
+        cursor.execute('CREATE INDEX IF NOT EXISTS %s ON sale_cart (%s)' % (
+            name, ', '.join(columns)))
+
+@tryton.transaction(readonly=False)
+def _prune_carts_chunk(domain, limit_date, last_id, chunk, writer=None):
+    '''Delete a chunk of old carts (id over last_id) in its own transaction.
+    Carts of sessions with an anonymous cart used since limit_date are kept;
+    they are searched by the sids of the chunk only.
+    Return a tuple (scanned carts, deleted carts, last id)'''
+    carts = Cart.search(domain + [('id', '>', last_id)], limit=chunk,
+        order=[('id', 'ASC')])
+    if not carts:
+        return 0, 0, last_id
+    values = Cart.read([c.id for c in carts], CART_ARCHIVE_FIELDS)
+    sids = list({v['sid'] for v in values if v['sid']})
+    active_sids = set()
+    if sids:
+        active = Cart.search([
+            ('state', '=', 'draft'),
+            ('shop', '=', SHOP),
+            ('galatea_user', '=', None),
+            ('sid', 'in', sids),
+            ('cart_date', '>=', limit_date),
+            ])
+        active_sids = {v['sid']
+            for v in Cart.read([c.id for c in active], ['sid'])}
+
+    to_delete = [v for v in values if v['sid'] not in active_sids]
+    if writer:
+        for value in to_delete:
+            writer.writerow([value[f] for f in CART_ARCHIVE_FIELDS])
+    Cart.delete(Cart.browse([v['id'] for v in to_delete]))
+    return len(carts), len(to_delete), carts[-1].id
+
+def prune_carts(days=30, chunk=500, archive=None):
+    '''Delete anonymous draft carts older than days, by chunks of carts.
+    Sessions with a cart used in the last days are untouched.
+    When archive is a file, deleted carts are appended as CSV rows.
+    Return a tuple (rows, seconds)'''
+    start = time.time()
+    limit_date = date.today() - timedelta(days=days)
+    domain = [
+        ('state', '=', 'draft'),
+        ('shop', '=', SHOP),
+        ('galatea_user', '=', None),
+        ('cart_date', '<', limit_date),
+        ]
+
+    writer = csv.writer(archive) if archive else None
+    rows = 0
+    last_id = 0
+    while True:
+        scanned, deleted, last_id = _prune_carts_chunk(domain, limit_date,
+            last_id, chunk, writer)
+        rows += deleted
+        if scanned < chunk:
+            break
+    return rows, time.time() - start
+
+def mini_cart_key():
+    '''Return the mini cart cache key (and ETag) of the current session.
+    The key changes with the session and user cart versions and every
+    TRYTON_CART_MINI_CART_CACHE_TIMEOUT seconds, so changes made out of the
+    web (back office) are seen after the timeout at most'''
+    user = session.get('user') or ''
+    period = (int(time.time() // MINI_CART_CACHE_TIMEOUT)
+        if MINI_CART_CACHE_TIMEOUT else 0)
+    return 'galatea-cart-mini:%s:%s:%s:%s:%s:%s' % (session.sid, user,
+        cart_version(), user_cart_version(user), period, g.language)
+
+@cart.route('/json/my-cart', methods=['GET', 'PUT'], endpoint="my-cart")
+def my_cart(lang):
+    '''All Carts JSON.
+    Response is cached by cart version and sent with a strong ETag'''
+    key = mini_cart_key()
+    etag = hashlib.md5(key).hexdigest()
+    if request.method == 'GET' and request.if_none_match.contains(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+
+    data = MINI_CART_CACHE.get(key)
+    if data is None:
+        data = json.dumps({'result': load_my_cart()})
+        MINI_CART_CACHE.set(key, data, MINI_CART_CACHE_TIMEOUT)
+
+    response = current_app.response_class(data, mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+@read_transaction
+def load_my_cart():
+    '''Return mini cart values: currency and items'''
+    items = []
+
+    config = shop_config()
+    carts = session_carts()
+
+    decimals = "%0."+str(config.currency_digits)+"f" # "%0.2f" euro
+    for (cart_id, code, rec_name, slug, img, quantity, unit_price,
+            unit_price_w_tax, untaxed_amount, amount_w_tax) in \
+            load_mini_cart(carts):
+        image = cart_thumbnail(img)
         items.append({
-            'id': cart.id,
-            'name': cart.product.code if MINI_CART_CODE else cart.product.rec_name,
+            'id': cart_id,
+            'name': code if MINI_CART_CODE else rec_name,
             'url': url_for('catalog.product_'+g.language, lang=g.language,
-                slug=cart.product.template.esale_slug),
-            'quantity': cart.quantity,
-            'unit_price': float(Decimal(decimals % cart.unit_price)),
-            'unit_price_w_tax': float(Decimal(decimals % cart.unit_price_w_tax)),
-            'untaxed_amount': float(Decimal(decimals % cart.untaxed_amount)),
-            'amount_w_tax': float(Decimal(decimals % cart.amount_w_tax)),
+                slug=slug),
+            'quantity': quantity,
+            'unit_price': float(Decimal(decimals % unit_price)),
+            'unit_price_w_tax': float(Decimal(decimals % unit_price_w_tax)),
+            'untaxed_amount': float(Decimal(decimals % untaxed_amount)),
+            'amount_w_tax': float(Decimal(decimals % amount_w_tax)),
             'image': image,
             })
 
-    return jsonify(result={
-        'currency': shop.esale_currency.symbol,
+    return {
+        'currency': config.currency_symbol,
         'items': items,
+        }
+
+def carrier_quote_serializer():
+    return URLSafeSerializer(current_app.secret_key,
+        salt='galatea-cart-carrier-quote')
+
+def save_carrier_quote(carrier_id, price, price_w_tax, payment_id=None,
+        party_id=None, untaxed_amount=None):
+    '''Save in session the signed carrier quote of the current cart version.
+    Carrier formulas depend on the payment type, the party and the amount of
+    the carts, so the quote is bound to them'''
+    user = session.get('user')
+    session['carrier_quote'] = carrier_quote_serializer().dumps({
+        'carrier': carrier_id,
+        'price': str(price),
+        'price_w_tax': str(price_w_tax),
+        'version': cart_version(),
+        'user': user,
+        'user_version': user_cart_version(user),
+        'amount': str(untaxed_amount),
+        'payment': payment_id,
+        'party': party_id,
         })
 
+def load_carrier_quote(carrier_id, payment_id=None, party_id=None,
+        untaxed_amount=None):
+    '''Return (price, price_w_tax) of the carrier quote saved by checkout.
+    Return None when there is no quote, the signature is not valid or the
+    quote is from another carrier, cart version (of the session or the user),
+    payment type, party or untaxed amount'''
+    user = session.get('user')
+    token = session.get('carrier_quote')
+    if not token:
+        return None
+    try:
+        quote = carrier_quote_serializer().loads(token)
+    except BadSignature:
+        return None
+    if (quote.get('carrier') != carrier_id
+            or quote.get('version') != cart_version()
+            or quote.get('user') != user
+            or quote.get('user_version') != user_cart_version(user)
+            or quote.get('amount') != str(untaxed_amount)
+            or quote.get('payment') != payment_id
+            or quote.get('party') != party_id):
+        return None
+    return Decimal(quote['price']), Decimal(quote['price_w_tax'])
+
+def checkout_sale(carts, party, values, shipment_price=None, timer=None,
+        quote=True):
+    '''Create a sale from carts, add the shipment line and quote it.
+    All values are computed before, so each phase is a single call:
+    carts (set party), sale (create), shipment (line) and quote.
+    Return a tuple (sale, error); sale is None when it is not created'''
+    timer = timer or PhaseTimer()
+
+    # Carts are same party to create a new sale
+    to_write = [c for c in carts if c.party != party]
+    if to_write:
+        Cart.write(to_write, {'party': party})
+    timer.mark('carts')
+
+    with uncounted_reads():
+        sales, error = Cart.create_sale(carts, values)
+    bump_cart_version()
+    timer.mark('sale')
+    if not sales:
+        return None, error
+    sale, = sales
+
+    # Add shipment line
+    if shipment_price is not None:
+        product = Product(shop_config().delivery_product)
+        with uncounted_reads():
+            shipment_line = SaleLine.get_shipment_line(product,
+                shipment_price, sale, party)
+            shipment_line.save()
+    timer.mark('shipment')
+
+    # sale draft to quotation
+    if quote:
+        try:
+            with uncounted_reads():
+                Sale.quote([sale])
+        except Exception as e:
+            current_app.logger.info(e)
+        timer.mark('quote')
+    return sale, error
+
 @cart.route("/confirm/", methods=["POST"], endpoint="confirm")
 @tryton.transaction()
 def confirm(lang):
     '''Convert carts to sale order
     Return to Sale Details
     '''
+    timer = PhaseTimer()
     shop = Shop(SHOP)
     data = request.form
 
@@ -245,20 +1506,7 @@ def confirm(lang):
     shipment_address = data.get('shipment_address')
 
     # Get all carts
-    domain = [
-        ('state', '=', 'draft'),
-        ('shop', '=', SHOP),
-        ]
-    if session.get('user'): # login user
-        domain.append(['OR', 
-            ('sid', '=', session.sid),
-            ('galatea_user', '=', session['user']),
-            ])
-    else: # anonymous user
-        domain.append(
-            ('sid', '=', session.sid),
-            )
-    carts = Cart.search(domain)
+    carts = session_carts()
     if not carts:
         flash(_('There are not products in your cart.'), 'danger')
         return redirect(url_for('.cart', lang=g.language))
@@ -343,8 +1591,7 @@ def confirm(lang):
         shipment_address = Address.esale_create_address(
             shop, party, values, type='delivery')
 
-    # Carts are same party to create a new sale
-    Cart.write(carts, {'party': party})
+    timer.mark('prepare')
 
     # Create new sale
     values = {}
@@ -366,131 +1613,187 @@ def confirm(lang):
     if session.get('user'): # login user
         values['galatea_user'] = session['user']
 
-    sales, error = Cart.create_sale(carts, values)
+    # Shipment price from the checkout quote (never from the request)
+    shipment_price = None
+    if carrier:
+        quote = load_carrier_quote(int(carrier), values.get('payment_type'),
+            party.id, sum(c.untaxed_amount for c in carts))
+        if quote:
+            shipment_price = quote[0]
+        else:
+            summary = cart_summary(carts)
+            shipment_price = carrier_price(int(carrier), party.id,
+                summary['untaxed_amount'], summary['tax_amount'],
+                summary['total_amount'], values.get('payment_type'))[0]
+
+    sale, error = checkout_sale(carts, party, values, shipment_price, timer,
+        quote=not QUOTE_DEFERRED)
     if error:
         if not session.get('logged_in') and session.get('customer'):
             session.pop('customer', None)
         current_app.logger.error('Sale. Error create sale from party (%s): %s' % (party.id, error))
-    if not sales:
+    if not sale:
         flash(_('It has not been able to convert the cart into an order. ' \
             'Try again or contact us.'), 'danger')
         return redirect(url_for('.cart', lang=g.language))
-    sale, = sales
 
-    # Add shipment line
-    carrier_price = data.get('carrier-cost')
-    if carrier_price:
-        product = shop.esale_delivery_product
-        shipment_price = Decimal(carrier_price)
-        shipment_line = SaleLine.get_shipment_line(product, shipment_price, sale, party)
-        shipment_line.save()
+    if QUOTE_DEFERRED:
+        # recorded with the sale, enqueued when the transaction is committed
+        sale_id = sale.id
+        QUOTE_QUEUE.record(sale_id)
 
-    # sale draft to quotation
-    try:
-        Sale.quote([sale])
-    except Exception as e:
-        current_app.logger.info(e)
+        @after_this_request
+        def enqueue_quote(response):
+            QUOTE_QUEUE.start(current_app._get_current_object())
+            QUOTE_QUEUE.enqueue(sale_id)
+            return response
 
     if current_app.debug:
-        current_app.logger.info('Sale. Create sale %s' % sale.id)
+        current_app.logger.info('Sale. Create sale %s (%s)' % (sale.id, timer))
 
     flash(_('Successfully created a new order.'), 'success')
 
     return redirect(url_for('sale.sale', lang=g.language, id=sale.id))
 
-@csrf.exempt
-@cart.route("/add/", methods=["POST"], endpoint="add")
-@tryton.transaction()
-def add(lang):
-    '''Add product item cart'''
-    websites = Website.search([
-        ('id', '=', GALATEA_WEBSITE),
-        ], limit=1)
-    if not websites:
-        abort(404)
-    website, = websites
-
+def invalidate_stock_cache(product_ids=None):
+    '''Remove cached stock quantities of products (all products by default)'''
+    if product_ids is None:
+        STOCK_CACHE.clear()
+        return
+    for product_id in product_ids:
+        for field in ('esale_quantity', 'esale_forecast_quantity'):
+            STOCK_CACHE.delete((field, product_id))
+
+def product_quantities(website, products):
+    '''Return available quantity of products {product id: quantity}.
+    Quantities are computed in one read for all products, using the website
+    stock quantity field (quantity or forecast quantity)'''
+    if website.esale_stock_qty == 'forecast_quantity':
+        field = 'esale_forecast_quantity'
+    else:
+        field = 'esale_quantity'
+
+    quantities = {}
+    to_read = []
+    for product_id in {p.id for p in products}:
+        quantity = STOCK_CACHE.get((field, product_id))
+        if quantity is None:
+            to_read.append(product_id)
+        else:
+            quantities[product_id] = quantity
+    if to_read:
+        for value in Product.read(to_read, [field]):
+            quantities[value['id']] = value[field]
+            if STOCK_CACHE_TIMEOUT:
+                STOCK_CACHE.set((field, value['id']), value[field])
+    return quantities
+
+def stock_shortages(website, lines):
+    '''Return stock shortages from a list of (product, quantity).
+    A shortage is a dict with product, quantity (available) and requested.
+    Return an empty list when the website not check stock'''
+    if not website.esale_stock:
+        return []
+    lines = [(p, qty) for p, qty in lines if p.type in PRODUCT_TYPE_STOCK]
+    if not lines:
+        return []
+    quantities = product_quantities(website, [l[0] for l in lines])
+
+    shortages = []
+    for product, qty in lines:
+        quantity = quantities[product.id]
+        if not (quantity > 0 and qty <= quantity):
+            shortages.append({
+                'product': product,
+                'quantity': quantity,
+                'requested': qty,
+                })
+    return shortages
+
+def flash_shortage(shortage):
+    '''Flash a not enought stock message from a stock shortage'''
+    flash(_('Not enought stock for the product "{product}" (maximun: {quantity} units).').format(
+        product=shortage['product'].rec_name,
+        quantity=shortage['quantity']), 'danger')
+
+def invalidate_cart_defaults():
+    '''Remove cached cart default values (call when configuration changes)'''
+    CART_DEFAULTS_CACHE.clear()
+
+def cart_defaults():
+    '''Return the default values of a new cart.
+    Defaults are cached by website, shop and day'''
+    key = (GALATEA_WEBSITE, SHOP, date.today())
+    defaults = CART_DEFAULTS_CACHE.get(key)
+    if defaults is None:
+        defaults = Cart.default_get(Cart._fields.keys(), with_rec_name=False)
+        CART_DEFAULTS_CACHE.set(key, defaults)
+    return defaults.copy()
+
+def new_carts(lines, party=None):
+    '''Return new cart records (not saved) from a list of
+    (product, quantity). Products are records from the same browse list,
+    so on_change_product reads product fields in bulk'''
+    defaults = cart_defaults()
+    carts = []
+    for product, qty in lines:
+        cart = Cart()
+        for key in defaults:
+            setattr(cart, key, defaults[key])
+        cart.party = party
+        cart.quantity = qty
+        cart.product = product
+        cart.sid = session.sid
+        cart.galatea_user = session.get('user', None)
+        cart.on_change_product()
+        carts.append(cart)
+    return carts
+
+def update_carts(website, values, codes=None, removes=None, errors=None):
+    '''Add, update or remove carts of the current user or session.
+    values is a dict {product id or code: quantity}, codes the keys of values
+    that are product codes and removes a list of cart ids to delete.
+    Codes and ids that are not found (or not sold in the shop) are appended
+    to errors as {"code": code} or {"product": id} when a list is given.
+    Lookups use dicts built once, so the cost is linear in the lines.
+    Return a tuple (created, updated, removed)'''
     to_create = []
     to_update = []
     to_remove = []
     to_remove_products = [] # Products in older cart and don't sell
 
-    # Convert form values to dict values {'id': 'qty'}
-    values = {}
-    codes = []
-
-    # json request
-    if request.json:
-        for data in request.json:
-            if data.get('name'):
-                prod = data.get('name').split('-')
-                try:
-                    qty = float(data.get('value'))
-                except:
-                    qty = 1
-                try:
-                    values[int(prod[1])] = qty
-                except:
-                    values[prod[1]] = qty
-                    codes.append(prod[1])
-
-        if not values:
-            return jsonify(result=False)
-    # post request
-    else:
-        for k, v in request.form.iteritems():
-            prod = k.split('-')
-            if prod[0] == 'product':
-                try:
-                    qty = float(v)
-                except:
-                    flash(_('You try to add no numeric quantity. ' \
-                        'The request has been stopped.'))
-                    return redirect(url_for('.cart', lang=g.language))
-                try:
-                    values[int(prod[1])] = qty
-                except:
-                    values[prod[1]] = qty
-                    codes.append(prod[1])
-
     # transform product code to id
     if codes:
-        products = Product.search([('code', 'in', codes)])
+        codes = set(codes)
+        products = Product.search([('code', 'in', list(codes))])
+        products_by_code = dict((p.code, p.id) for p in products)
         # reset dict
         vals = values.copy()
         values = {}
 
-        for k, v in vals.items():
-            for prod in products:
-                if prod.code == k:
-                    values[prod['id']] = v
-                    break
-
-    # Remove items in cart
-    removes = request.form.getlist('remove')
+        for k, v in vals.iteritems():
+            if k not in codes:
+                values[k] = v
+            elif k in products_by_code:
+                values[products_by_code[k]] = v
+            elif errors is not None:
+                errors.append({'code': k})
 
     # Products Current User Cart (products to send)
-    products_current_cart = [k for k,v in values.iteritems()]
+    products_current_cart = values.keys()
+    count_cart_lines(len(values) + len(removes or []))
 
     # Search current cart by user or session
-    domain = [
-        ('state', '=', 'draft'),
-        ('shop', '=', SHOP),
-        ('product.id', 'in', products_current_cart)
+    domain = cart_domain() + [
+        ('product.id', 'in', products_current_cart),
         ]
-    if session.get('user'): # login user
-        domain.append(['OR', 
-            ('sid', '=', session.sid),
-            ('galatea_user', '=', session['user']),
-            ])
-    else: # anonymous user
-        domain.append(
-            ('sid', '=', session.sid),
-            )
     carts = Cart.search(domain, order=[('cart_date', 'ASC')])
 
     # Products Current Cart (products available in sale.cart)
-    products_in_cart = [c.product.id for c in carts]
+    carts_by_id = dict((c.id, c) for c in carts)
+    carts_by_product = {}
+    for c in carts:
+        carts_by_product.setdefault(c.product.id, c)
 
     # Get product data
     products = Product.search([
@@ -499,75 +1802,56 @@ def add(lang):
         ('template.esale_active', '=', True),
         ('template.shops', 'in', [SHOP]),
         ])
+    products_by_id = dict((p.id, p) for p in products)
+    if errors is not None:
+        errors.extend({'product': k} for k in products_current_cart
+            if k not in products_by_id)
 
     # Delete products data
-    if removes:
-        for remove in removes:
-            for cart in carts:
-                try:
-                    if cart.id == int(remove):
-                        to_remove.append(cart)
-                        break
-                except:
-                    flash(_('You try to remove no numeric cart. ' \
-                        'The request has been stopped.'))
-                    return redirect(url_for('.cart', lang=g.language))
+    for remove in removes or []:
+        if remove in carts_by_id:
+            to_remove.append(carts_by_id[remove])
+
+    # Stock available of all products
+    shortages = dict((s['product'].id, s) for s in stock_shortages(website,
+            [(products_by_id[k], v) for k, v in values.iteritems()
+                if k in products_by_id]))
 
     # Add/Update products data
     for product_id, qty in values.iteritems():
-        product = None
-        for p in products:
-            if p.id == product_id:
-                product = p
-                break
+        product = products_by_id.get(product_id)
 
         if not product or not product.add_cart:
             continue
 
         # Add cart if have stock
-        if website.esale_stock:
-            if website.esale_stock_qty == 'forecast_quantity':
-                quantity = product.esale_forecast_quantity
-            else:
-                quantity = product.esale_quantity
-            if product.type in PRODUCT_TYPE_STOCK and not (quantity > 0 and qty <= quantity):
-                flash(_('Not enought stock for the product "{product}" (maximun: {quantity} units).').format(
-                    product=product.rec_name, quantity=quantity), 'danger')
-                continue
-
-        cart = Cart()
-        defaults = cart.default_get(cart._fields.keys(), with_rec_name=False)
-        for key in defaults:
-            setattr(cart, key, defaults[key])
-        cart.party = session.get('customer', None)
-        cart.quantity = qty
-        cart.product = product.id
-        cart.sid = session.sid
-        cart.galatea_user = session.get('user', None)
-        cart.on_change_product()
+        if product_id in shortages:
+            flash_shortage(shortages[product_id])
+            continue
 
         # Create data
-        if product_id not in products_in_cart and qty > 0:
-            to_create.append(cart._save_values)
+        if product_id not in carts_by_product and qty > 0:
+            to_create.append((product, qty))
         # Update data
-        if product_id in products_in_cart: 
-            for cart in carts:
-                if cart.product.id == product_id:
-                    if qty > 0:
-                        cart.quantity = qty
-                        cart.on_change_quantity()
-                        to_update.extend(([cart], cart._save_values))
-                    else: # Remove data when qty <= 0
-                        to_remove.append(cart)
-                    break
+        if product_id in carts_by_product:
+            cart = carts_by_product[product_id]
+            if qty > 0:
+                cart.quantity = qty
+                cart.on_change_quantity()
+                to_update.extend(([cart], cart._save_values))
+            else: # Remove data when qty <= 0
+                to_remove.append(cart)
 
     # Add to remove older products
-    if to_remove_products:
-        for remove in to_remove_products:
-            for cart in carts:
-                if cart.product.id == remove:
-                    to_remove.append(cart)
-                    break
+    for remove in to_remove_products:
+        if remove in carts_by_product:
+            to_remove.append(carts_by_product[remove])
+
+    to_create = [c._save_values for c in new_carts(to_create,
+            session.get('customer', None))]
+
+    if to_create or to_update or to_remove:
+        bump_cart_version()
 
     # Add Cart
     if to_create:
@@ -596,34 +1880,183 @@ def add(lang):
             '%(num)s products have been deleted in your cart.',
             len(to_remove)), 'success')
 
+    return len(to_create), len(to_update)/2, len(to_remove)
+
+def flash_messages():
+    '''Pop flashes from session and return JSON messages (success, warning)'''
+    success = []
+    warning = []
+    for f in session.get('_flashes', []):
+        if f[0] == 'success':
+            success.append(f[1])
+        else:
+            warning.append(f[1])
+    messages = {}
+    messages['success'] = ",".join(success)
+    messages['warning'] = ",".join(warning)
+
+    session.pop('_flashes', None)
+    return messages
+
+@csrf.exempt
+@cart.route("/add/", methods=["POST"], endpoint="add")
+@tryton.transaction()
+def add(lang):
+    '''Add product item cart'''
+    website = website_config()
+    if not website:
+        abort(404)
+
+    # Convert form values to dict values {'id': 'qty'}
+    values = {}
+    codes = []
+
+    # json request
     if request.json:
-        # Add JSON messages (success, warning)
-        success = []
-        warning = []
-        for f in session.get('_flashes', []):
-            if f[0] == 'success':
-                success.append(f[1])
-            else:
-                warning.append(f[1])
-        messages = {}
-        messages['success'] = ",".join(success)
-        messages['warning'] = ",".join(warning)
+        for data in request.json:
+            if data.get('name'):
+                prod = data.get('name').split('-')
+                try:
+                    qty = float(data.get('value'))
+                except:
+                    qty = 1
+                try:
+                    values[int(prod[1])] = qty
+                except:
+                    values[prod[1]] = qty
+                    codes.append(prod[1])
 
-        session.pop('_flashes', None)
-        return jsonify(result=True, messages=messages)
+        if not values:
+            return jsonify(result=False)
+    # post request
+    else:
+        for k, v in request.form.iteritems():
+            prod = k.split('-')
+            if prod[0] == 'product':
+                try:
+                    qty = float(v)
+                except:
+                    flash(_('You try to add no numeric quantity. ' \
+                        'The request has been stopped.'))
+                    return redirect(url_for('.cart', lang=g.language))
+                try:
+                    values[int(prod[1])] = qty
+                except:
+                    values[prod[1]] = qty
+                    codes.append(prod[1])
+
+    # Remove items in cart
+    removes = []
+    for remove in request.form.getlist('remove'):
+        try:
+            removes.append(int(remove))
+        except:
+            flash(_('You try to remove no numeric cart. ' \
+                'The request has been stopped.'))
+            return redirect(url_for('.cart', lang=g.language))
+
+    update_carts(website, values, codes, removes)
+
+    if request.json:
+        # Add JSON messages (success, warning)
+        return jsonify(result=True, messages=flash_messages())
     else:
         return redirect(url_for('.cart', lang=g.language))
 
+def parse_quantity(value):
+    '''Return a quantity (float) of a number or a string.
+    Strings that are not a plain number are parsed with the decimal and
+    group separators of the request locale ("1,5" in es).
+    Raise ValueError when it is not a number'''
+    if isinstance(value, bool):
+        raise ValueError(value)
+    if isinstance(value, (int, long, float, Decimal)):
+        return float(value)
+    if not isinstance(value, basestring):
+        raise ValueError(value)
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        return float(parse_decimal(value, locale=get_locale()))
+
+@csrf.exempt
+@cart.route("/json/add-bulk", methods=["POST"], endpoint="add-bulk")
+@tryton.transaction()
+def add_bulk(lang):
+    '''Add many product items cart (JSON).
+    Accept a list of lines {"code": code, "quantity": qty} (or "product"
+    with the product id) or a "csv" text with "code;quantity" rows (or tab
+    separated, as copied from a spreadsheet). Quantities may use the decimal
+    separator of the locale ("1,5")'''
+    website = website_config()
+    if not website:
+        abort(404)
+
+    data = request.get_json(silent=True) or {}
+    lines = data.get('lines', []) if isinstance(data, dict) else data
+    if isinstance(data, dict) and data.get('csv'):
+        text = data['csv']
+        delimiter = '\t' if '\t' in text else ';'
+        lines = []
+        for row in csv.reader(text.encode('utf-8').splitlines(),
+                delimiter=delimiter):
+            row = [c.decode('utf-8').strip() for c in row]
+            if not row or not row[0]:
+                continue
+            lines.append({
+                'code': row[0],
+                'quantity': row[1] if len(row) > 1 and row[1] else 1,
+                })
+
+    values = {}
+    codes = []
+    errors = []
+    if not isinstance(lines, list):
+        errors.append(lines)
+        lines = []
+    for line in lines:
+        if not isinstance(line, dict):
+            errors.append(line)
+            continue
+        try:
+            qty = parse_quantity(line.get('quantity', 1))
+        except (TypeError, ValueError):
+            errors.append(line)
+            continue
+        if line.get('product'):
+            try:
+                values[int(line['product'])] = qty
+            except (TypeError, ValueError):
+                errors.append(line)
+        elif line.get('code'):
+            values[line['code']] = qty
+            codes.append(line['code'])
+        else:
+            errors.append(line)
+
+    if not values:
+        return jsonify(result=False, errors=errors)
+
+    created, updated, removed = update_carts(website, values, codes,
+        errors=errors)
+
+    return jsonify(
+        result=True,
+        created=created,
+        updated=updated,
+        removed=removed,
+        errors=errors,
+        messages=flash_messages(),
+        )
+
 @cart.route("/checkout/", methods=["GET", "POST"], endpoint="checkout")
 @tryton.transaction()
 def checkout(lang):
     '''Checkout user or session'''
-    websites = Website.search([
-        ('id', '=', GALATEA_WEBSITE),
-        ], limit=1)
-    if not websites:
+    website = website_config()
+    if not website:
         abort(404)
-    website, = websites
 
     values = {}
     errors = []
@@ -631,20 +2064,7 @@ def checkout(lang):
 
     email = request.form.get('invoice_email') or request.form.get('shipment_email')
 
-    domain = [
-        ('state', '=', 'draft'),
-        ('shop', '=', SHOP),
-        ]
-    if session.get('user'): # login user
-        domain.append(['OR', 
-            ('sid', '=', session.sid),
-            ('galatea_user', '=', session['user']),
-            ])
-    else: # anonymous user
-        domain.append(
-            ('sid', '=', session.sid),
-            )
-    carts = Cart.search(domain, order=CART_ORDER)
+    carts = session_carts()
     if not carts:
         flash(_('There are not products in your cart.'), 'danger')
         return redirect(url_for('.cart', lang=g.language))
@@ -660,25 +2080,18 @@ def checkout(lang):
             flash(_('Your email is already registed user. Please, login in.'), 'danger')
             return redirect(url_for('.cart', lang=g.language))
 
-    untaxed_amount = Decimal(0)
-    tax_amount = Decimal(0)
-    total_amount = Decimal(0)
-    for cart in carts:
-        untaxed_amount += cart.untaxed_amount
-        tax_amount += cart.amount_w_tax - cart.untaxed_amount
-        total_amount += cart.amount_w_tax
-        # checkout stock available
-        if website.esale_stock:
-            if cart.product.type not in PRODUCT_TYPE_STOCK:
-                continue
-            if website.esale_stock_qty == 'forecast_quantity':
-                quantity = cart.product.esale_forecast_quantity
-            else:
-                quantity = cart.product.esale_quantity
-            if not (cart.quantity > 0 and cart.quantity <= quantity):
-                flash(_('Not enought stock for the product "{product}" (maximun: {quantity} units).').format(
-                    product=cart.product.rec_name, quantity=quantity), 'danger')
-                return redirect(url_for('.cart', lang=g.language))
+    summary = cart_summary(carts)
+    untaxed_amount = summary['untaxed_amount']
+    tax_amount = summary['tax_amount']
+    total_amount = summary['total_amount']
+
+    # checkout stock available
+    shortages = stock_shortages(website,
+        [(c.product, c.quantity) for c in carts])
+    if shortages:
+        for shortage in shortages:
+            flash_shortage(shortage)
+        return redirect(url_for('.cart', lang=g.language))
 
     party = None
     if session.get('customer'):
@@ -815,33 +2228,23 @@ def checkout(lang):
             values['payment'] = payment_type.id
             values['payment_name'] = payment_type.rec_name
     if not payment_type:
-        for p in shop.esale_payments:
-            if p.payment_type.id == payment:
-                payment_type = p.payment_type
-                values['payment'] = payment_type.id
-                values['payment_name'] = payment_type.rec_name
-                break
+        if payment in shop_config().payment_ids:
+            payment_type = PaymentType(payment)
+            values['payment'] = payment_type.id
+            values['payment_name'] = payment_type.rec_name
 
     # Carrier
     carrier_id = request.form.get('carrier')
     if carrier_id:
         carrier = Carrier(carrier_id)
 
-        # create a virtual sale
-        sale = Sale()
-        sale.untaxed_amount = untaxed_amount
-        sale.tax_amount = tax_amount
-        sale.total_amount = total_amount
-        sale.carrier = carrier
-        sale.payment_type = payment_type
-
-        context = {}
-        context['record'] = sale # Eval by "carrier formula" require "record"
-        context['carrier'] = carrier
-        with Transaction().set_context(context):
-            carrier_price = carrier.get_sale_price() # return price, currency
-        price = carrier_price[0]
-        price_w_tax = carrier.get_sale_price_w_tax(price, party=party)
+        # price from a virtual sale, saved signed for confirm
+        price, price_w_tax = carrier_price(carrier.id,
+            party.id if party else None, untaxed_amount, tax_amount,
+            total_amount, payment_type.id if payment_type else None)
+        save_carrier_quote(carrier.id, price, price_w_tax,
+            payment_type.id if payment_type else None,
+            party.id if party else None, untaxed_amount)
         values['carrier'] = carrier
         values['carrier_name'] = carrier.rec_name
         values['carrier_cost'] = price
@@ -860,7 +2263,7 @@ def checkout(lang):
         }]
 
     return render_template('checkout.html',
-            website=website,
+            website=Website(website.id),
             breadcrumbs=breadcrumbs,
             shop=shop,
             carts=carts,
@@ -873,57 +2276,99 @@ def checkout(lang):
                 },
             )
 
+def template_crossells(template_ids):
+    '''Return cross sell ids of templates {template id: array of ids}.
+    The table is kept by shop; only templates not in the table are read
+    (call invalidate_crossells when cross sells change)'''
+    table = {}
+    to_read = []
+    for template_id in template_ids:
+        crossells = CROSSSELLS_CACHE.get((SHOP, template_id))
+        if crossells is None:
+            to_read.append(template_id)
+        else:
+            table[template_id] = crossells
+    if to_read:
+        for value in Template.read(to_read, ['esale_crosssells_by_shop']):
+            crossells = array('l', value['esale_crosssells_by_shop'])
+            CROSSSELLS_CACHE.set((SHOP, value['id']), crossells)
+            table[value['id']] = crossells
+    return table
+
+def invalidate_crossells(template_ids=None):
+    '''Remove cross sells of templates from the table (all by default)'''
+    if template_ids is None:
+        CROSSSELLS_CACHE.clear()
+        return
+    for template_id in template_ids:
+        CROSSSELLS_CACHE.delete((SHOP, template_id))
+
+def cart_crossells(template_ids):
+    '''Return the LIMIT_CROSSELLS best cross sell templates of cart templates.
+    Cross sells related to more cart templates rank first, then by their
+    position in the template cross sells. Cart templates are excluded'''
+    ranks = {}
+    for crossells in template_crossells(template_ids).itervalues():
+        for position, crossell_id in enumerate(crossells):
+            count, best = ranks.get(crossell_id, (0, position))
+            ranks[crossell_id] = (count + 1, min(best, position))
+    for template_id in template_ids:
+        ranks.pop(template_id, None)
+    if not ranks:
+        return []
+    crossells_ids = heapq.nsmallest(LIMIT_CROSSELLS, ranks,
+        key=lambda k: (-ranks[k][0], ranks[k][1], k))
+    return Template.browse(crossells_ids)
+
+@cart.route('/json/crossells', methods=['GET'], endpoint="crossells")
+@read_transaction
+def crossells(lang):
+    '''Return cross sells of the current cart (JSON)'''
+    items = []
+    if CART_CROSSSELLS:
+        summary = cart_summary()
+        for template in cart_crossells(summary['template_ids']):
+            image = cart_thumbnail(template.esale_default_images)
+            items.append({
+                'id': template.id,
+                'name': template.rec_name,
+                'url': url_for('catalog.product_'+g.language,
+                    lang=g.language, slug=template.esale_slug),
+                'image': image,
+                })
+    return jsonify(result=items)
+
 @cart.route("/", endpoint="cart")
-@tryton.transaction()
+@read_transaction
 def cart_list(lang):
     '''Cart by user or session'''
-    websites = Website.search([
-        ('id', '=', GALATEA_WEBSITE),
-        ], limit=1)
-    if not websites:
+    website = website_config()
+    if not website:
         abort(404)
-    website, = websites
 
     shop = Shop(SHOP)
+    config = shop_config()
+    country_id, country_code = config.country
+    countries = list(config.countries)
 
     form_invoice_address = InvoiceAddressForm(
-        country=shop.esale_country.id,
-        vat_country=shop.esale_country.code)
-    countries = [(c.id, c.name) for c in shop.esale_countrys]
+        country=country_id,
+        vat_country=country_code)
     form_invoice_address.invoice_country.choices = countries
-    form_invoice_address.vat_country.choices = VAT_COUNTRIES
+    form_invoice_address.vat_country.choices = vat_countries()
 
     form_shipment_address = ShipmentAddressForm(
-        country=shop.esale_country.id,
-        vat_country=shop.esale_country.code)
-    countries = [(c.id, c.name) for c in shop.esale_countrys]
+        country=country_id,
+        vat_country=country_code)
     form_shipment_address.shipment_country.choices = countries
-    form_shipment_address.vat_country.choices = VAT_COUNTRIES
+    form_shipment_address.vat_country.choices = vat_countries()
 
-    domain = [
-        ('state', '=', 'draft'),
-        ('shop', '=', SHOP),
-        ]
-    if session.get('user'): # login user
-        domain.append(['OR', 
-            ('sid', '=', session.sid),
-            ('galatea_user', '=', session['user']),
-            ])
-    else: # anonymous user
-        domain.append(
-            ('sid', '=', session.sid),
-            )
-    carts = Cart.search(domain, order=CART_ORDER)
+    carts = session_carts()
 
-    products = []
-    untaxed_amount = Decimal(0)
-    tax_amount = Decimal(0)
-    total_amount = Decimal(0)
-    for cart in carts:
-        products.append(cart.product.id)
-        untaxed_amount += cart.untaxed_amount
-        tax_amount += cart.amount_w_tax - cart.untaxed_amount
-        total_amount += cart.amount_w_tax
+    summary = cart_summary(carts)
+    untaxed_amount = summary['untaxed_amount']
+    tax_amount = summary['tax_amount']
+    total_amount = summary['total_amount']
 
     party = None
     addresses = []
@@ -950,9 +2395,9 @@ def cart_list(lang):
     # Get payments. Shop payments or Party payment
     payments = []
     default_payment = None
-    if shop.esale_payments:
-        default_payment = shop.esale_payments[0].payment_type
-        payments = [payment.payment_type for payment in shop.esale_payments]
+    if config.payment_ids:
+        payments = PaymentType.browse(list(config.payment_ids))
+        default_payment = payments[0]
         if party:
             if hasattr(party, 'customer_payment_type'):
                 if party.customer_payment_type:
@@ -963,9 +2408,10 @@ def cart_list(lang):
             payments.append(customer_payment)
 
     # Get carriers. Shop carriers or Party carrier
-    stockable = Carrier.get_products_stockable(products)
+    # Deferred cart loads carriers and cross sells from JSON endpoints
+    stockable = summary['stockable']
     carriers = []
-    if stockable:
+    if stockable and not CART_DEFERRED:
         carriers = get_carriers(
             shop=shop,
             party=party,
@@ -976,15 +2422,8 @@ def cart_list(lang):
 
     # Cross Sells
     crossells = []
-    if CART_CROSSSELLS:
-        template_ids = list({c.product.template.id for c in carts})
-        templates = Template.browse(template_ids)
-        crossells_ids = set()
-        for template in templates:
-            for crossell in template.esale_crosssells_by_shop:
-                crossells_ids.add(crossell.id)
-        if crossells_ids:
-            crossells = Template.browse(list(crossells_ids)[:LIMIT_CROSSELLS])
+    if CART_CROSSSELLS and not CART_DEFERRED:
+        crossells = cart_crossells(summary['template_ids'])
 
     # Breadcumbs
     breadcrumbs = [{
@@ -993,7 +2432,7 @@ def cart_list(lang):
         }]
 
     return render_template('cart.html',
-            website=website,
+            website=Website(website.id),
             breadcrumbs=breadcrumbs,
             shop=shop,
             carts=carts,
@@ -1010,6 +2449,7 @@ def cart_list(lang):
             default_payment=default_payment,
             carriers=carriers,
             stockable=stockable,
+            deferred=CART_DEFERRED,
             prices={
                 'untaxed_amount': untaxed_amount,
                 'tax_amount': tax_amount,
@@ -1019,7 +2459,7 @@ def cart_list(lang):
 
 @cart.route("/pending", endpoint="cart-pending")
 @login_required
-@tryton.transaction()
+@read_transaction
 def cart_pending(lang):
     '''Last cart pending'''
     order = [
@@ -1070,6 +2510,7 @@ def clone(lang):
         return redirect(url_for('.sales', lang=g.language))
 
     sale, = sales
+    count_cart_lines(len(sale.lines))
 
     products = set()
     for l in sale.lines:
@@ -1077,46 +2518,45 @@ def clone(lang):
             products.add(l.product.id)
 
     # Search current carts by user or session
-    domain = [
-        ('state', '=', 'draft'),
-        ('shop', '=', SHOP),
-        ]
-    if session.get('user'): # login user
-        domain.append(['OR', 
-            ('sid', '=', session.sid),
-            ('galatea_user', '=', session['user']),
-            ])
-    else: # anonymous user
-        domain.append(
-            ('sid', '=', session.sid),
-            )
-    carts = Cart.search(domain, order=[('cart_date', 'ASC')])
+    carts = session_carts()
 
     # remove products that exist in current cart
     for c in carts:
         if c.product.id in products:
             products.remove(c.product.id)
 
-    to_create = []
-    for product_id in products:
-        cart = Cart()
-        defaults = cart.default_get(cart._fields.keys(), with_rec_name=False)
-        for key in defaults:
-            setattr(cart, key, defaults[key])
-        cart.party = sale.party.id
-        cart.quantity = 1
-        cart.product = product_id
-        cart.sid = session.sid
-        cart.galatea_user = session.get('user', None)
-        cart.on_change_product()
-
-        to_create.append(cart._save_values)
+    to_create = [c._save_values for c in new_carts(
+            [(p, 1) for p in Product.browse(list(products))],
+            sale.party.id)]
 
     if to_create:
         Cart.create(to_create)
+        bump_cart_version()
         flash(ngettext(
             '%(num)s product has been added in your cart.',
             '%(num)s products have been added in your cart.',
             len(to_create)), 'success')
 
     return redirect(url_for('.cart', lang=g.language))
+
+@cart.before_request
+def start_query_budget():
+    '''Snapshot the ORM calls before the view.
+    Registered last, so it runs after the other before_request hooks'''
+    g.cart_budget_start = orm_calls()
+
+if hasattr(current_app, 'cli'):
+    import click
+
+    @current_app.cli.command('cart-prune')
+    @click.option('--days', default=30,
+        help='Delete anonymous draft carts older than days.')
+    @click.option('--chunk', default=500,
+        help='Carts deleted by transaction.')
+    @click.option('--archive', type=click.File('ab'), default=None,
+        help='Append deleted carts to a CSV file.')
+    def cart_prune(days, chunk, archive):
+        '''Delete abandoned anonymous carts'''
+        rows, seconds = prune_carts(days, chunk, archive)
+        click.echo('Pruned %s carts in %.2fs (%.1f rows/s)' % (rows, seconds,
+            rows / seconds if seconds else rows))